@@ -0,0 +1,161 @@
+import argparse, json, os, shutil, statistics, subprocess, sys, tempfile, time
+
+__bench_dir__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(__bench_dir__))
+
+from rbuild.cli import Builder, parse_reqs, RequirementsCache
+
+def write(path, lines):
+    d = os.path.dirname(path)
+    if d and not os.path.exists(d): os.makedirs(d)
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+# Requirements spread over nested files that include each other with -f,
+# along with local directories that have to be hashed
+def generate_requirements(src, reqs, depth, local_deps, local_files):
+    per_file = max(1, reqs // (depth + 1))
+    for level in range(depth + 1):
+        lines = ['# level {}'.format(level)]
+        if level < depth:
+            lines.append('-f reqs/level{}.txt'.format(level + 1) if level == 0 else '-f level{}.txt'.format(level + 1))
+        for i in range(level * per_file, min(reqs, (level + 1) * per_file)):
+            lines.append('org{0}/pkg{1}@v1.{1} -DPKG{1}_OPTION=On -DBUILD_TESTING=Off'.format(i % 7, i))
+        write(os.path.join(src, 'requirements.txt' if level == 0 else os.path.join('reqs', 'level{}.txt'.format(level))), lines)
+    deps = []
+    for i in range(local_deps):
+        dep = os.path.join(src, 'local', 'dep{}'.format(i))
+        write(os.path.join(dep, 'CMakeLists.txt'), ['project(dep{})'.format(i)])
+        for j in range(local_files):
+            write(os.path.join(dep, 'include', 'file{}.h'.format(j)), ['// dep {} file {}'.format(i, j)] * 50)
+        deps.append('local/dep{}'.format(i))
+    return deps
+
+# An ini file with many sessions that inherit from each other
+def generate_ini(src, sessions, defines, local_deps):
+    lines = ['[main]', 'deps = -f requirements.txt']
+    lines.extend('    ' + dep for dep in local_deps)
+    lines.append('define =')
+    lines.extend('    OPTION_{}=${{deps_dir}}/opt{}'.format(i, i) for i in range(defines))
+    for i in range(sessions):
+        lines.extend(['', '[session{}]'.format(i), 'deps = ${main:deps}', 'define =', '    ${main:define}', '    SESSION_{}=On'.format(i), 'cxx = g++', 'build_type = Release'])
+    write(os.path.join(src, 'rbuild.ini'), lines)
+
+def generate_project(root, args):
+    src = os.path.join(root, 'src')
+    local_deps = generate_requirements(src, args.reqs, args.depth, args.local_deps, args.local_files)
+    generate_ini(src, args.sessions, args.defines, local_deps)
+    # Files changed in the last couple of seconds are not cached by rbuild,
+    # so make them old enough to be
+    old = time.time() - 60
+    for d, _, files in os.walk(src):
+        for f in files:
+            os.utime(os.path.join(d, f), (old, old))
+    return src
+
+# cget and cmake that do nothing, so only the time spent in rbuild is measured
+def generate_stubs(root):
+    bin_dir = os.path.join(root, 'bin')
+    for name in ['cget', 'cmake']:
+        if os.name == 'nt':
+            write(os.path.join(bin_dir, name + '.bat'), ['@exit /b 0'])
+        else:
+            write(os.path.join(bin_dir, name), ['#!/bin/sh', 'exit 0'])
+            os.chmod(os.path.join(bin_dir, name), 0o755)
+    return bin_dir
+
+def measure(f, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup: setup()
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def run_benchmarks(args):
+    root = tempfile.mkdtemp(prefix='rbuild-bench-')
+    try:
+        src = generate_project(root, args)
+        env = dict(os.environ, RBUILD_CACHE_DIR=os.path.join(root, 'cache'))
+        env['PATH'] = generate_stubs(root) + os.pathsep + env['PATH']
+        # Run the rbuild in this tree rather than an installed one
+        env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(__bench_dir__)] + [x for x in [os.environ.get('PYTHONPATH')] if x])
+        deps = os.path.join(root, 'deps')
+        def rb(*xs):
+            subprocess.check_call([sys.executable, '-c', 'from rbuild.cli import cli; cli()'] + list(xs), cwd=src, env=env, stdout=subprocess.DEVNULL)
+        def clean():
+            shutil.rmtree(deps, ignore_errors=True)
+        results = {}
+        results['startup'] = measure(lambda: rb('--version'), args.repeat)
+        results['hash'] = measure(lambda: rb('hash'), args.repeat)
+        results['prepare'] = measure(lambda: rb('prepare', '-d', deps), args.repeat, setup=clean)
+        results['prepare_noop'] = measure(lambda: rb('prepare', '-d', deps), args.repeat)
+        cwd = os.getcwd()
+        os.chdir(src)
+        # The builders in this process save their caches there as well
+        cache_dir = os.environ.get('RBUILD_CACHE_DIR')
+        os.environ['RBUILD_CACHE_DIR'] = env['RBUILD_CACHE_DIR']
+        try:
+            ini = os.path.join(src, 'rbuild.ini')
+            sessions = ['session{}'.format(i) for i in range(args.sessions)]
+            results['config'] = measure(lambda: [Builder(s, source_dir=src, deps_dir=deps) for s in sessions], args.repeat)
+            results['parse_reqs'] = measure(lambda: list(parse_reqs(['-f requirements.txt'], path=ini)), args.repeat)
+            cache = RequirementsCache(None)
+            results['parse_reqs_cached'] = measure(lambda: list(parse_reqs(['-f requirements.txt'], path=ini, cache=cache)), args.repeat)
+            b = Builder('session0', source_dir=src, cache_dir=os.path.join(root, 'cache'))
+            b.compute_hash()
+            results['compute_hash_warm'] = measure(b.compute_hash, args.repeat)
+        finally:
+            os.chdir(cwd)
+            if cache_dir is None:
+                del os.environ['RBUILD_CACHE_DIR']
+            else:
+                os.environ['RBUILD_CACHE_DIR'] = cache_dir
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+# Benchmarks slower than the baseline by more than the threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, t in sorted(results.items()):
+        base = baseline.get(name)
+        ratio = t / base if base else None
+        status = ''
+        if ratio is not None and ratio > 1 + threshold:
+            status = 'REGRESSION'
+            regressions.append(name)
+        print('{:<20} {:>10.4f}s {:>10} {:>8} {}'.format(name, t, '{:.4f}s'.format(base) if base else '-', '{:.2f}x'.format(ratio) if ratio else '-', status))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the overhead of rbuild on a synthetic project')
+    parser.add_argument('--reqs', type=int, default=500, help='Number of requirement lines')
+    parser.add_argument('--depth', type=int, default=5, help='Depth of the nested -f includes')
+    parser.add_argument('--sessions', type=int, default=100, help='Number of sessions in rbuild.ini')
+    parser.add_argument('--defines', type=int, default=50, help='Number of defines in the main session')
+    parser.add_argument('--local-deps', type=int, default=20, help='Number of local dependencies')
+    parser.add_argument('--local-files', type=int, default=50, help='Number of files in each local dependency')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times to run each benchmark, the median is reported')
+    parser.add_argument('--baseline', default=os.path.join(__bench_dir__, 'baseline.json'), help='Results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed slowdown compared to the baseline')
+    parser.add_argument('--save', help='Write the results to this file, such as to update the baseline')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if regressions:
+        print('Slower than the baseline: ' + ', '.join(regressions))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
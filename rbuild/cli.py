@@ -1,13 +1,21 @@
 import click
+import collections
+import contextlib
 import configparser
 import functools
 import glob
 import hashlib
-import multiprocessing
+import json
+import itertools
 import os
+import posixpath
+import re
 import shlex
 import shutil
 import subprocess
+import sys
+import threading
+import time
 from builtins import str
 
 from rbuild import __version__
@@ -85,18 +93,424 @@ def make_args(**kwargs):
 def make_defines(defines):
     return ['-D'+x for x in defines]
 
-def read_reqs(lines, path=None, ignore=None):
-    start = os.path.dirname(path) if path else None
+# A file modified again within the mtime resolution would keep the same
+# stamp, so only remember files that have settled
+def is_settled(st):
+    return time.time() - st.st_mtime > 2
+
+# Entries keyed by file path stored as json, which can be shared between runs
+class JsonFileCache:
+    # Entries kept when saving, the least recently used ones are dropped first
+    max_entries = None
+
+    def __init__(self, file=None):
+        self.file = file
+        self.entries = {}
+        self.changed = False
+        if file and os.path.exists(file):
+            try:
+                with open(file) as f:
+                    self.entries = json.load(f)
+            except (ValueError, OSError):
+                pass
+
+    # Entries are kept in the order they were last used
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        self.changed = True
+
+    def get_path(self, key):
+        return key
+
+    # Drop the entries of files that are gone and the oldest ones past the limit
+    def prune(self):
+        if not self.max_entries:
+            return
+        entries = [(k, e) for k, e in self.entries.items() if os.path.exists(self.get_path(k))]
+        self.entries = dict(entries[-self.max_entries:])
+
+    # The cache only saves time, so it is left out when it can't be written
+    def save(self):
+        if not self.file or not self.changed:
+            return
+        self.prune()
+        tmp = '{}.{}.{}'.format(self.file, os.getpid(), threading.get_ident())
+        try:
+            mkdir(os.path.dirname(self.file))
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.file)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.changed = False
+
+def split_lines(lines):
     for line in lines:
         tokens = shlex.split(line, comments=True)
-        if len(tokens) == 0:
-            continue
+        if len(tokens) > 0:
+            yield tokens
+
+# Tokens of each line of a requirements file, reused while the mtime and
+# size of the file stay the same
+class RequirementsCache(JsonFileCache):
+    max_entries = 1000
+
+    def read(self, path):
+        if not os.path.exists(path):
+            return []
+        st = os.stat(path)
+        stamp = [st.st_mtime_ns, st.st_size]
+        entry = self.get(path)
+        if entry and entry[0] == stamp:
+            return entry[1]
+        tokens = list(split_lines(read_from(path)))
+        if is_settled(st):
+            self.put(path, [stamp, tokens])
+        return tokens
+
+def parse_reqs(lines, path=None, ignore=None, cache=None):
+    return parse_req_tokens(split_lines(lines), path=path, ignore=ignore, cache=cache, parents=[])
+
+def parse_req_tokens(token_lines, path=None, ignore=None, cache=None, parents=None):
+    start = os.path.dirname(path) if path else None
+    for tokens in token_lines:
         if tokens[0] == '-f':
             f = actual_path(tokens[1], start)
-            for x in read_reqs(read_from(f), path=f, ignore=ignore):
+            if f in parents:
+                raise RuntimeError('Recursive requirements file: ' + ' -> '.join(parents + [f]))
+            token_lines = cache.read(f) if cache else split_lines(read_from(f))
+            for x in parse_req_tokens(token_lines, path=f, ignore=ignore, cache=cache, parents=parents + [f]):
                 yield x
         elif not tokens[0].startswith(tuple(ignore or [])):
-            yield ' '.join(tokens)
+            yield Requirement(tokens, start)
+
+def read_reqs(lines, path=None, ignore=None, cache=None):
+    for req in parse_reqs(lines, path=path, ignore=ignore, cache=cache):
+        yield req.line()
+
+# Options in a requirements line that take a value
+req_value_options = ['-D', '--define', '-H', '--hash', '-X', '--cmake', '-f', '--file']
+
+class Requirement:
+    def __init__(self, tokens, start=None):
+        self.tokens = list(tokens)
+        self.start = start
+
+    def line(self):
+        return ' '.join(self.tokens)
+
+    def package(self):
+        it = iter(self.tokens)
+        for token in it:
+            if token in req_value_options:
+                next(it, None)
+            elif not token.startswith('-'):
+                return token
+        return None
+
+    def url(self):
+        return (self.package() or '').split(',')[-1]
+
+    def name(self):
+        pkg = self.package()
+        if pkg is None:
+            return None
+        if ',' in pkg:
+            return pkg.split(',')[0]
+        return pkg.split('@')[0]
+
+    def local_path(self):
+        p = actual_path(self.url(), self.start)
+        if self.url() and os.path.exists(p):
+            return p
+        return None
+
+    # Names of the packages this requirement needs, or None if they can't be
+    # known without fetching it
+    def requires(self):
+        p = self.local_path()
+        if p is None or not os.path.isdir(p):
+            return None
+        if '--ignore-requirements' in self.tokens:
+            return []
+        f = os.path.join(p, 'requirements.txt')
+        return [req.name() for req in parse_reqs(read_from(f), path=f)]
+
+    # Tokens with local paths made absolute so they can be installed from any directory
+    def resolved_tokens(self):
+        result = []
+        it = iter(self.tokens)
+        for token in it:
+            result.append(token)
+            if token in ['-D', '--define', '-H', '--hash']:
+                result.append(next(it, ''))
+            elif not token.startswith('-'):
+                alias, sep, url = token.rpartition(',')
+                p = actual_path(url, self.start)
+                if os.path.exists(p):
+                    result[-1] = alias + sep + p
+        return result
+
+    def local_files(self):
+        result = []
+        for token in self.resolved_tokens():
+            p = token.rpartition(',')[2]
+            if os.path.isabs(p) and os.path.exists(p):
+                result.append(p)
+        return result
+
+# Commit that a branch or tag of a github repo points to
+def get_github_commit(repo, ref):
+    if re.match(r'^[0-9a-f]{40}$', ref):
+        return ref
+    out = subprocess.check_output(['git', 'ls-remote', 'https://github.com/{}'.format(repo), ref]).decode('utf-8')
+    refs = dict(reversed(line.split('\t')) for line in out.splitlines() if '\t' in line)
+    # Annotated tags are peeled to the commit they point to
+    for name in [ref, 'refs/heads/' + ref, 'refs/tags/{}^{{}}'.format(ref), 'refs/tags/' + ref]:
+        if name in refs:
+            return refs[name]
+    raise RuntimeError('Could not resolve {}@{}'.format(repo, ref))
+
+def get_url_digest(url):
+    import urllib.request
+    m = hashlib.sha256()
+    with contextlib.closing(urllib.request.urlopen(url)) as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            m.update(chunk)
+    return 'sha256:' + m.hexdigest()
+
+# Url that cget downloads a requirement from, or None for local requirements
+# and recipes
+def get_source_url(req):
+    if req.local_path():
+        return None
+    url = req.url()
+    if '://' in url:
+        return url
+    repo, ref = parse_repo_name(url)
+    # Same as cget, a single name is a repo with the same name as its owner
+    if '/' not in repo:
+        repo = repo + '/' + repo
+    return 'https://github.com/{}/archive/{}.tar.gz'.format(repo, ref or 'HEAD')
+
+# Name and version cget looks up a recipe or github repo with, where a repo
+# named the same as its owner is reduced to a single name
+def parse_repo_name(url):
+    repo, _, ref = url.partition('@')
+    if len(set(repo.split('/'))) == 1:
+        repo = repo.split('/')[0]
+    return repo, ref
+
+# Recipe cget installs the requirement with, or None when it is not a recipe
+def get_recipe(req, recipe_paths):
+    if req.local_path() or '://' in req.url():
+        return None
+    repo, ref = parse_repo_name(req.url())
+    for path in recipe_paths:
+        recipe = os.path.join(path, repo, ref)
+        if os.path.exists(recipe):
+            return recipe
+    return None
+
+def get_req_digest(tokens):
+    for i, token in enumerate(tokens[:-1]):
+        if token in ['-H', '--hash']:
+            return tokens[i + 1]
+    return None
+
+# Requirement pinned to a commit and the digest of what cget downloads, or
+# None for local requirements and recipes that can't be pinned
+def lock_requirement(req):
+    if get_source_url(req) is None:
+        return None
+    pkg = req.package()
+    alias, sep, url = pkg.rpartition(',')
+    if '://' not in url and url.partition('@')[0].count('/') != 1:
+        return None
+    tokens = list(req.tokens)
+    if '://' not in url:
+        repo, _, ref = url.partition('@')
+        tokens[tokens.index(pkg)] = alias + sep + repo + '@' + get_github_commit(repo, ref or 'HEAD')
+    if get_req_digest(tokens) is None:
+        tokens.extend(['-H', get_url_digest(get_source_url(Requirement(tokens)))])
+    return {'tokens': tokens}
+
+# Requirements that each requirement has to be installed after. The
+# requirements of a remote package are only known once it is fetched, or
+# from the mirror. cget installs the requirements that no line before
+# provides along with the package, possibly at the same time as another line
+# does, so unless unknown is false such a requirement is installed after
+# every requirement before it and before every one after.
+def get_req_graph(reqs, unknown=True, ignore=None, mirror=None):
+    graph = {}
+    requires = []
+    names = set()
+    for req in reqs:
+        r = req.requires() if mirror is None or req.local_path() else mirror.get_required_names(req, ignore)
+        if r is not None and not all(name in names or name.startswith(tuple(ignore or [])) for name in r):
+            r = None
+        requires.append(r)
+        names.add(req.name())
+    for i, req in enumerate(reqs):
+        if requires[i] is None:
+            graph[i] = list(range(i)) if unknown else []
+        else:
+            graph[i] = [j for j in range(i) if reqs[j].name() in requires[i] or (unknown and requires[j] is None)]
+    return graph
+
+# Split the graph into n shards of requirements that need each other, so each
+# shard can be installed without the others
+def get_shards(graph, n):
+    parent = {key: key for key in graph}
+    def find(key):
+        while parent[key] != key:
+            key = parent[key]
+        return key
+    for key, deps in graph.items():
+        for dep in deps:
+            parent[find(dep)] = find(key)
+    components = {}
+    for key in graph:
+        components.setdefault(find(key), []).append(key)
+    shards = [[] for _ in range(n)]
+    for component in sorted(components.values(), key=lambda c: (-len(c), c[0])):
+        min(shards, key=len).extend(component)
+    return [sorted(shard) for shard in shards]
+
+def parse_shard(s):
+    m = re.match(r'^(\d+)/(\d+)$', s or '')
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise click.BadParameter('Shard must be i/n with 1 <= i <= n, such as 2/4, not {}'.format(s))
+    return (int(m.group(1)), int(m.group(2)))
+
+# Processes started by the tasks of a run_graph, so that when one task fails
+# the commands of the other tasks can be stopped
+class ProcessGroup:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.cancelled = False
+
+    def add(self, p):
+        with self.lock:
+            self.processes.add(p)
+            if self.cancelled:
+                kill_process(p)
+
+    def remove(self, p):
+        with self.lock:
+            self.processes.discard(p)
+
+    def cancel(self, sig=None):
+        with self.lock:
+            self.cancelled = True
+            for p in self.processes:
+                kill_process(p, sig)
+
+# Forward SIGINT and SIGTERM to the commands of the group, which don't get
+# them from the terminal or a ci timeout when they run in a session of their
+# own, and then handle them as before
+@contextlib.contextmanager
+def forward_signals(group):
+    import signal
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous = {}
+    def handler(signum, frame):
+        group.cancel(signum)
+        h = previous[signum]
+        if callable(h):
+            h(signum, frame)
+        elif h != signal.SIG_IGN:
+            sys.exit(128 + signum)
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        previous[sig] = signal.signal(sig, handler)
+    try:
+        yield
+    finally:
+        for sig, h in previous.items():
+            signal.signal(sig, h if h is not None else signal.SIG_DFL)
+
+# Label and process group of the task running on the current thread, and
+# whether other tasks can run at the same time
+task_context = threading.local()
+output_lock = threading.Lock()
+
+def get_task_label():
+    return getattr(task_context, 'label', None)
+
+def is_task_concurrent():
+    return getattr(task_context, 'concurrent', False)
+
+def get_task_group():
+    return getattr(task_context, 'group', None)
+
+def run_graph(graph, f, jobs=1, labels=None):
+    import concurrent.futures
+    import heapq
+    done = set()
+    running = {}
+    # Count the dependencies left for each task so the ready ones are found
+    # without going through the whole graph each time one finishes
+    order = {k: i for i, k in enumerate(graph)}
+    waiting = {k: len(set(graph[k])) for k in graph}
+    dependents = collections.defaultdict(list)
+    for k in graph:
+        for x in set(graph[k]):
+            dependents[x].append(k)
+    # Started in the order of the graph
+    ready = [(order[k], k) for k in graph if waiting[k] == 0]
+    # Nested graphs share the process group and the label of their task
+    nested = get_task_group() is not None
+    group = get_task_group() or ProcessGroup()
+    parent = get_task_label()
+    concurrent_tasks = jobs > 1 and len(graph) > 1
+    inherited = is_task_concurrent()
+    # Output is only prefixed when tasks can run at the same time
+    prefix = labels is not None and concurrent_tasks
+    def run(key):
+        task_context.group = group
+        task_context.label = '/'.join(x for x in [parent, labels[key] if prefix else None] if x) or None
+        task_context.concurrent = inherited or concurrent_tasks
+        try:
+            return f(key)
+        finally:
+            task_context.group = None
+            task_context.label = None
+            task_context.concurrent = False
+    with contextlib.ExitStack() as stack:
+        if not nested:
+            stack.enter_context(forward_signals(group))
+        executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)))
+        try:
+            while len(done) < len(graph):
+                while ready and len(running) < max(jobs, 1):
+                    key = heapq.heappop(ready)[1]
+                    running[executor.submit(run, key)] = key
+                if not running:
+                    raise RuntimeError('Cycle detected in: ' + ', '.join(str(k) for k in graph if k not in done))
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    key = running.pop(future)
+                    future.result()
+                    done.add(key)
+                    for k in dependents[key]:
+                        waiting[k] -= 1
+                        if waiting[k] == 0:
+                            heapq.heappush(ready, (order[k], k))
+        except BaseException:
+            # Stop the commands of the other tasks instead of waiting for them
+            group.cancel()
+            raise
 
 def compute_md5(lines):
     m = hashlib.md5()
@@ -149,7 +563,7 @@ def to_dict(items):
     r = {}
     for key, value in items:
         v = value
-        if key in ['global_define', 'define', 'ignore', 'deps']:
+        if key in ['global_define', 'define', 'ignore', 'deps', 'matrix', 'package_generator']:
             v = list(parse_lines(value))
         r[key] = v
     return r
@@ -167,6 +581,77 @@ def get_session_options(session, file=None, defaults={}):
             return to_dict(parser.items('default'))
     return to_dict(parser.items(session))
 
+# Defaults that change with the working directory, which are left out of the
+# cache key by resolving the sessions with a placeholder for them
+placeholder_defaults = ['deps_dir', 'build_dir']
+
+def replace_placeholders(value, placeholders):
+    if isinstance(value, list):
+        return [replace_placeholders(x, placeholders) for x in value]
+    for placeholder, x in placeholders.items():
+        value = value.replace(placeholder, x)
+    return value
+
+# Resolved options of the sessions of an ini file, reused while the mtime and
+# size of the file stay the same
+class ConfigCache(JsonFileCache):
+    max_entries = 1000
+
+    def get_path(self, key):
+        return json.loads(key)[0]
+
+    def get_session_options(self, session, file=None, defaults={}):
+        f = abspath(file or os.path.join(defaults.get('source_dir', os.getcwd()), 'rbuild.ini'))
+        if not os.path.exists(f):
+            return get_session_options(session, file, defaults=defaults)
+        st = os.stat(f)
+        stamp = [st.st_mtime_ns, st.st_size]
+        names = {name: '@rbuild:{}@'.format(name) for name in placeholder_defaults if name in defaults}
+        placeholders = {placeholder: defaults[name] for name, placeholder in names.items()}
+        defaults = merge(defaults, names)
+        key = json.dumps([f, session, convert_defaults(defaults)], sort_keys=True)
+        entry = self.get(key)
+        if not entry or entry[0] != stamp:
+            entry = [stamp, get_session_options(session, f, defaults=defaults)]
+            if is_settled(st):
+                # Drop the sessions resolved from older versions of the file
+                self.entries = {k: e for k, e in self.entries.items() if json.loads(k)[0] != f or e[0] == stamp}
+                self.put(key, entry)
+        return {k: replace_placeholders(v, placeholders) for k, v in entry[1].items()}
+
+config_cache = None
+
+def get_config_cache():
+    global config_cache
+    if config_cache is None:
+        cache_dir = get_cache_dir()
+        config_cache = ConfigCache(None if cache_dir.lower() == 'none' else os.path.join(abspath(os.path.expanduser(cache_dir)), 'config.json'))
+    return config_cache
+
+# Each line of a matrix is a setting followed by the values to build with,
+# such as `cxx = g++ clang++`, and a variant is built for each combination
+def parse_matrix(lines):
+    axes = []
+    for line in lines:
+        key, _, values = line.partition('=')
+        axes.append([(key.strip(), value) for value in shlex.split(values)])
+    if not axes:
+        return []
+    return [list(combination) for combination in itertools.product(*axes)]
+
+def get_variant_options(combination):
+    r = {}
+    for key, value in combination:
+        if key in ['global_define', 'define']:
+            r[key] = r.get(key, []) + [value]
+        else:
+            r[key] = value
+    return r
+
+def get_variant_name(session, combination):
+    name = '-'.join([session.replace('try:', '')] + [value for key, value in combination])
+    return re.sub(r'[^\w.+-]', '_', name)
+
 def sanitize_cmake_args(args):
     return [arg.replace(os.sep, '/') for arg in args]
 
@@ -179,23 +664,1221 @@ def get_rocm_path():
         return paths[0]
     return '/opt/rocm'
 
+def read_first_line(f):
+    return first(read_from(f), '').strip()
+
+def get_cgroup_cpus():
+    # cgroup v2
+    quota = read_first_line('/sys/fs/cgroup/cpu.max').split()
+    if len(quota) == 2 and quota[0] != 'max':
+        return max(1, -(-int(quota[0]) // int(quota[1])))
+    # cgroup v1
+    quota = read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and int(quota) > 0:
+        return max(1, -(-int(quota) // int(period)))
+    return None
+
+def get_cpu_count():
+    if hasattr(os, 'sched_getaffinity'):
+        n = len(os.sched_getaffinity(0))
+    else:
+        n = os.cpu_count() or 1
+    quota = get_cgroup_cpus()
+    if quota:
+        return min(n, quota)
+    return n
+
+def get_available_memory():
+    available = []
+    for line in read_from('/proc/meminfo'):
+        if line.startswith('MemAvailable:'):
+            available.append(int(line.split()[1]) * 1024)
+    for limit_file, usage_file in [('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        limit = read_first_line(limit_file)
+        usage = read_first_line(usage_file)
+        if limit.isdigit() and usage.isdigit():
+            available.append(max(0, int(limit) - int(usage)))
+    if available:
+        return min(available)
+    return None
+
+# Number of compile jobs the machine can run, limited by the cpus this
+# process may use and by how many jobs of job_memory bytes fit in memory
+def get_auto_jobs(job_memory=None):
+    n = get_cpu_count()
+    memory = get_available_memory()
+    if memory is not None and job_memory:
+        n = min(n, memory // job_memory)
+    return max(1, n)
+
+def find_compiler_launcher(launcher):
+    if not launcher or launcher.lower() == 'none':
+        return None
+    if launcher.lower() == 'auto':
+        return first(filter(None, (shutil.which(x) for x in ['ccache', 'sccache'])))
+    return shutil.which(launcher) or launcher
+
+def get_launcher_defines(launcher):
+    if not launcher:
+        return []
+    return ['CMAKE_{}_COMPILER_LAUNCHER={}'.format(lang, launcher) for lang in ['C', 'CXX', 'HIP']]
+
+# Total hits and misses reported by the compiler cache
+def get_launcher_stats(launcher):
+    name = os.path.basename(launcher).lower()
+    try:
+        if 'sccache' in name:
+            stats = json.loads(subprocess.check_output([launcher, '--show-stats', '--stats-format=json']).decode('utf-8'))['stats']
+            return sum(stats['cache_hits']['counts'].values()), sum(stats['cache_misses']['counts'].values())
+        if 'ccache' in name:
+            out = subprocess.check_output([launcher, '--print-stats']).decode('utf-8')
+            stats = dict(line.split('\t', 1) for line in out.splitlines() if '\t' in line)
+            return int(stats['direct_cache_hit']) + int(stats['preprocessed_cache_hit']), int(stats['cache_miss'])
+    except (OSError, subprocess.CalledProcessError, ValueError, KeyError):
+        pass
+    return None
+
+# Path and version of a compiler, so that binaries built by different
+# compilers with the same name are not shared
+def get_compiler_identity(compiler):
+    path = shutil.which(compiler)
+    if not path:
+        return compiler
+    try:
+        version = subprocess.check_output([path, '--version'], stderr=subprocess.STDOUT).decode('utf-8', 'replace')
+    except (OSError, subprocess.CalledProcessError):
+        version = ''
+    return ' '.join([os.path.realpath(path), first(version.splitlines(), '')])
+
+def get_cache_dir():
+    cache_dir = os.environ.get('RBUILD_CACHE_DIR')
+    if cache_dir is not None:
+        return cache_dir
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'rbuild')
+
+def parse_size(s):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    s = str(s).strip().upper().rstrip('B')
+    if s and s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+def get_dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            f = os.path.join(root, file)
+            if not os.path.islink(f):
+                size += os.path.getsize(f)
+    return size
+
+def is_text_file(path):
+    with open(path, 'rb') as f:
+        return b'\0' not in f.read(8192)
+
+# Same encoding cget uses for the directory names of its packages
+def get_cget_fname(req):
+    import base64
+    alias, _, url = (req.package() or '').rpartition(',')
+    name = alias or None
+    if '://' not in url:
+        local = req.local_path()
+        if local:
+            url = 'file://' + local
+        else:
+            p = url.split('@')[0]
+            ps = p.split('/')
+            if len(set(ps)) == 1:
+                p = ps[0]
+            name = name or p
+    if name:
+        return name.replace('/', '__')
+    x = base64.urlsafe_b64encode(url[url.find('://')+3:].encode('utf-8')).decode('utf-8')
+    return '_url_' + x.replace('=', '_')
+
+def get_cget_pkg_closure(prefix, fname):
+    pkg_dir = os.path.join(prefix, 'cget', 'pkg')
+    result = [fname]
+    for x in result:
+        for pkg in sorted(os.listdir(pkg_dir)):
+            if pkg not in result and os.path.exists(os.path.join(pkg_dir, pkg, 'deps', x)):
+                result.append(pkg)
+    return result
+
+ignore_fingerprint_dirs = ['.git', '.hg', '.svn']
+
+# Content digests of local files, reused between runs while the mtime and
+# size of the file stay the same
+class Fingerprints(JsonFileCache):
+    max_entries = 100000
+
+    def hash_file(self, path):
+        st = os.stat(path)
+        stamp = [st.st_mtime_ns, st.st_size]
+        entry = self.get(path)
+        if entry and entry[:2] == stamp:
+            return entry[2]
+        m = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                m.update(chunk)
+        digest = m.hexdigest()
+        if is_settled(st):
+            self.put(path, stamp + [digest])
+        return digest
+
+    def hash_path(self, path):
+        if not os.path.isdir(path):
+            return self.hash_file(path)
+        m = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if d not in ignore_fingerprint_dirs)
+            for file in sorted(files):
+                f = os.path.join(root, file)
+                m.update(os.path.relpath(f, path).replace(os.sep, '/').encode('utf-8'))
+                if os.path.islink(f):
+                    m.update(os.readlink(f).encode('utf-8'))
+                elif os.path.isfile(f):
+                    m.update(self.hash_file(f).encode('utf-8'))
+        return m.hexdigest()
+
+def get_exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def kill_process(p, sig=None):
+    import signal
+    sig = sig or signal.SIGTERM
+    try:
+        # Commands of tasks that run at the same time are in a session of
+        # their own so their children are stopped as well
+        if os.name == 'posix' and os.getpgid(p.pid) == p.pid:
+            os.killpg(p.pid, sig)
+        elif os.name == 'posix':
+            p.send_signal(sig)
+        else:
+            p.terminate()
+    except OSError:
+        pass
+
+# Run a command and return how long it took along with the resources used
+# by the process and its children, where the platform can report it
+# When log is given, the output is compressed into it as it is produced and
+# the last lines are kept in tail
+def run_command(c, log=None, tail=None, prefix=None, **kwargs):
+    import gzip
+    start = time.time()
+    group = get_task_group()
+    if log or prefix:
+        kwargs = merge(kwargs, {'stdout': subprocess.PIPE, 'stderr': subprocess.STDOUT})
+    if group and os.name == 'posix' and is_task_concurrent():
+        kwargs = merge(kwargs, {'start_new_session': True})
+    p = subprocess.Popen(c, **kwargs)
+    if group:
+        group.add(p)
+    usage = None
+    try:
+        if log:
+            with gzip.open(log, 'wb', compresslevel=6) as f:
+                for line in p.stdout:
+                    f.write(line)
+                    if tail is not None:
+                        tail.append(line)
+        elif prefix:
+            for line in p.stdout:
+                echo_lines([line], prefix=prefix)
+        if p.stdout:
+            p.stdout.close()
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(p.pid, 0)
+            p.returncode = get_exit_code(status)
+        else:
+            p.wait()
+    except BaseException:
+        if group:
+            kill_process(p)
+        raise
+    finally:
+        if group:
+            group.remove(p)
+    record = {
+        'command': list(c),
+        'cwd': os.path.abspath(kwargs.get('cwd') or os.getcwd()),
+        'start': start,
+        'wall': time.time() - start,
+        'exit_code': p.returncode
+    }
+    if log:
+        record['log'] = log
+    if usage is not None:
+        record['user'] = usage.ru_utime
+        record['sys'] = usage.ru_stime
+        # ru_maxrss is in bytes on macos and kilobytes elsewhere
+        record['maxrss_kb'] = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    return record
+
+def echo_line(line, prefix=None):
+    with output_lock:
+        click.echo((prefix or '') + line)
+
+def echo_lines(lines, prefix=None):
+    with output_lock:
+        for line in lines:
+            click.echo((prefix or '') + line.decode('utf-8', 'replace'), nl=False)
+
+def echo_log(log, prefix=None):
+    import gzip
+    with gzip.open(log, 'rb') as f:
+        echo_lines(f, prefix=prefix)
+
+log_counter = itertools.count(1)
+
+tracer_ids = itertools.count()
+
+class Tracer:
+    def __init__(self, file=None, runs_dir=None):
+        self.file = abspath(file) if file else None
+        self.runs_dir = runs_dir
+        self.records = []
+        self.lock = threading.Lock()
+        self.threads = {}
+        self.launchers = {}
+        self.start = time.time()
+        # Tracers created in the same millisecond are still saved separately
+        self.run_id = '{:013d}-{}-{:04d}'.format(int(self.start * 1000), os.getpid(), next(tracer_ids))
+        self.run_name = self.run_id + '.jsonl'
+        # Each run starts the json lines file again instead of adding to the
+        # records of the run before
+        if self.file and not self.is_chrome():
+            open(self.file, 'w').close()
+
+    # Files ending in .json are written as chrome trace events, otherwise
+    # each record is appended as a json line
+    def is_chrome(self):
+        return self.file is not None and self.file.endswith('.json')
+
+    def add(self, record):
+        with self.lock:
+            record['thread'] = self.threads.setdefault(threading.current_thread().name, len(self.threads))
+            self.records.append(record)
+            if self.file and not self.is_chrome():
+                with open(self.file, 'a') as f:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    @contextlib.contextmanager
+    def phase(self, name, **kwargs):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(merge({'phase': name, 'start': start, 'wall': time.time() - start}, kwargs))
+
+    def to_chrome_event(self, record):
+        name = ' '.join(record['command']) if 'command' in record else record.get('dep', record['phase'])
+        args = {key: value for key, value in record.items() if key not in ['start', 'wall', 'thread']}
+        return {'name': name, 'cat': record.get('phase', ''), 'ph': 'X', 'pid': os.getpid(), 'tid': record['thread'],
+                'ts': int(record['start'] * 1000000), 'dur': int(record['wall'] * 1000000), 'args': args}
+
+    # The records of the run are also kept in the runs directory, so rbuild
+    # report can compare them with the runs before
+    def save_run(self, ok):
+        run = {'run': ' '.join(sys.argv[1:]), 'start': self.start, 'wall': time.time() - self.start, 'cpus': get_cpu_count(), 'ok': ok, 'launchers': self.launchers}
+        mkdir(self.runs_dir)
+        with open(os.path.join(self.runs_dir, self.run_name), 'w') as f:
+            for record in [run] + self.records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+        for name in sorted(os.listdir(self.runs_dir))[:-max_runs]:
+            os.remove(os.path.join(self.runs_dir, name))
+
+    def close(self, ok=True):
+        if self.is_chrome():
+            with open(self.file, 'w') as f:
+                json.dump({'traceEvents': [self.to_chrome_event(r) for r in self.records]}, f)
+        if self.runs_dir and self.records:
+            self.save_run(ok)
+
+# Number of runs kept to compare against
+max_runs = 20
+
+def get_runs_dir(deps_dir):
+    return os.path.join(abspath(deps_dir), 'rbuild', 'runs')
+
+def read_runs(runs_dir):
+    runs = []
+    for name in sorted(os.listdir(runs_dir)) if os.path.isdir(runs_dir) else []:
+        with open(os.path.join(runs_dir, name)) as f:
+            runs.append([json.loads(line) for line in f if line.strip()])
+    return runs
+
+# Dependencies that each had to wait for the one before, ending with the
+# dependency that finished last
+def get_critical_path(deps):
+    by_name = {d['dep']: d for d in deps}
+    end = lambda d: d['start'] + d['wall']
+    path = []
+    d = max(deps, key=end) if deps else None
+    while d:
+        path.append(d)
+        before = [by_name[x] for x in d.get('requires', []) if x in by_name]
+        d = max(before, key=end) if before else None
+    return list(reversed(path))
+
+def summarize_run(records):
+    run = first((r for r in records if 'run' in r), {})
+    commands = [r for r in records if 'command' in r]
+    deps = [r for r in records if 'dep' in r]
+    cpus = run.get('cpus') or 1
+    # Phases of variants that ran at the same time overlap, so a phase lasts
+    # from its first start to its last end
+    phases = collections.OrderedDict()
+    for r in records:
+        if 'phase' in r and 'command' not in r and 'dep' not in r:
+            p = phases.setdefault(r['phase'], {'start': r['start'], 'end': r['start'] + r['wall'], 'cpu': 0.0, 'peak_memory_kb': 0})
+            p['start'] = min(p['start'], r['start'])
+            p['end'] = max(p['end'], r['start'] + r['wall'])
+    for r in commands:
+        p = phases.get(r.get('phase'))
+        if p:
+            p['cpu'] += r.get('user', 0) + r.get('sys', 0)
+            p['peak_memory_kb'] = max(p['peak_memory_kb'], r.get('maxrss_kb', 0))
+    for p in phases.values():
+        p['wall'] = p.pop('end') - p.pop('start')
+        p['utilization'] = p['cpu'] / (p['wall'] * cpus) if p['wall'] > 0 else 0
+    path = get_critical_path(deps)
+    launchers = run.get('launchers', {})
+    return {
+        'run': run.get('run', ''),
+        'wall': run.get('wall', 0),
+        'cpus': cpus,
+        'ok': run.get('ok', True),
+        'phases': phases,
+        'deps': collections.OrderedDict((d['dep'], {'wall': d['wall'], 'cached': d.get('cached', False)}) for d in sorted(deps, key=lambda d: -d['wall'])),
+        'critical_path': [d['dep'] for d in path],
+        'critical_path_wall': path[-1]['start'] + path[-1]['wall'] - path[0]['start'] if path else 0,
+        'cache': {'restored': len([d for d in deps if d.get('cached')]), 'built': len([d for d in deps if not d.get('cached')]), 'launchers': launchers},
+        'peak_memory_kb': max([r.get('maxrss_kb', 0) for r in commands] or [0]),
+        'slowest': [{'command': ' '.join(r['command']), 'phase': r.get('phase'), 'wall': r['wall']} for r in sorted(commands, key=lambda r: -r['wall'])[:10]]
+    }
+
+# Phases and dependencies built from source that took longer than the median
+# of the successful runs before of the same command, since other commands do
+# different work in the same phases
+def get_regressions(summary, previous, threshold=0.25):
+    import statistics
+    result = []
+    previous = [s for s in previous if s['run'] == summary['run']]
+    items = [('phase ' + name, p['wall'], [s['phases'][name]['wall'] for s in previous if name in s['phases']]) for name, p in summary['phases'].items()]
+    items.extend((name, d['wall'], [s['deps'][name]['wall'] for s in previous if name in s['deps'] and not s['deps'][name]['cached']]) for name, d in summary['deps'].items() if not d['cached'])
+    for name, wall, walls in items:
+        if not walls:
+            continue
+        base = statistics.median(walls)
+        # Ignore small differences in steps that are quick anyway
+        if wall > base * (1 + threshold) and wall - base > 1:
+            result.append({'name': name, 'wall': wall, 'baseline': base})
+    return result
+
+def format_kb(kb):
+    return '{:.1f}M'.format(kb / 1024.0) if kb < 1 << 20 else '{:.1f}G'.format(kb / float(1 << 20))
+
+def echo_report(summary, regressions):
+    click.echo('Run: rbuild {} ({:.1f}s on {} cpus{})'.format(summary['run'], summary['wall'], summary['cpus'], '' if summary['ok'] else ', failed'))
+    click.echo('Phases:')
+    for name, p in summary['phases'].items():
+        click.echo('  {:<12} {:>8.1f}s  cpu {:>8.1f}s  {:>4.0f}% of {} cpus  peak memory {}'.format(name, p['wall'], p['cpu'], 100 * p['utilization'], summary['cpus'], format_kb(p['peak_memory_kb'])))
+    cache = summary['cache']
+    if summary['deps']:
+        click.echo('Dependencies ({} built, {} restored from cache, {:.0f}% hit rate):'.format(cache['built'], cache['restored'], 100.0 * cache['restored'] / len(summary['deps'])))
+        for name, d in summary['deps'].items():
+            click.echo('  {:<40} {:>8.1f}s{}'.format(name, d['wall'], '  cached' if d['cached'] else ''))
+        click.echo('Critical path ({:.1f}s): {}'.format(summary['critical_path_wall'], ' -> '.join(summary['critical_path'])))
+    for launcher, (hits, misses) in sorted(cache['launchers'].items()):
+        if hits + misses > 0:
+            click.echo('Compiler cache: {} {} hits, {} misses ({:.1f}% hit rate)'.format(launcher, hits, misses, 100.0 * hits / (hits + misses)))
+    click.echo('Peak memory: {}'.format(format_kb(summary['peak_memory_kb'])))
+    if summary['slowest']:
+        click.echo('Slowest steps:')
+        for r in summary['slowest']:
+            click.echo('  {:>8.1f}s  {:<10} {}'.format(r['wall'], r['phase'] or '', r['command']))
+    if regressions:
+        click.echo('Slower than previous runs:')
+        for r in regressions:
+            click.echo('  {:<40} {:>8.1f}s vs {:.1f}s ({:.2f}x)'.format(r['name'], r['wall'], r['baseline'], r['wall'] / r['baseline'] if r['baseline'] else 0))
+
+# Placeholder for the dependency directory in stored files, so the same file
+# installed into different dependency directories is only stored once
+prefix_placeholder = '@RBUILD_PREFIX@'
+
+def reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            # FICLONE, supported by btrfs, xfs and bcachefs on linux
+            fcntl.ioctl(fdst.fileno(), 0x40049409, fsrc.fileno())
+
+# Create dst with the contents of src, sharing the data on disk when the
+# filesystem allows it and falling back to a copy
+def materialize(src, dst, mode, link='auto'):
+    if link in ['auto', 'reflink']:
+        try:
+            reflink(src, dst)
+            os.chmod(dst, mode)
+            return
+        except (ImportError, OSError):
+            if os.path.exists(dst):
+                os.remove(dst)
+    if link in ['auto', 'hardlink']:
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    os.chmod(dst, mode)
+
+def remove_file(path):
+    # Stored files are read-only, which windows will not remove
+    os.chmod(path, 0o644)
+    os.remove(path)
+
+def is_object_name(name):
+    return re.match(r'^[0-9a-f]{64}(-x)?$', name) is not None
+
+def is_safe_path(path):
+    return not os.path.isabs(path) and '..' not in path.replace('\\', '/').split('/')
+
+# A link may only point into its own package, or into the prefix when it
+# was stored with the placeholder
+def is_safe_link(path, link):
+    if link.startswith(prefix_placeholder):
+        return is_safe_path(link[len(prefix_placeholder):].lstrip('/'))
+    if os.path.isabs(link) or '\\' in link:
+        return False
+    target = posixpath.normpath(posixpath.join(posixpath.dirname(path), link))
+    return target.split('/')[0] == path.split('/')[0]
+
+def is_subpath(path, parent):
+    return path == parent or path.startswith(parent.rstrip(os.sep) + os.sep)
+
+# Cache of installed packages. The files are stored once by their content
+# under objects and each entry lists the files of its packages.
+class DepCache:
+    def __init__(self, path, max_size, link='auto'):
+        self.path = path
+        self.max_size = max_size
+        self.link = link
+
+    def get_path(self, *ps):
+        return os.path.join(self.path, *ps)
+
+    def get_object(self, name):
+        return self.get_path('objects', name[:2], name[2:])
+
+    def get_object_mode(self, name):
+        return 0o755 if name.endswith('-x') else 0o644
+
+    def read_info(self, key):
+        with open(self.get_path(key, 'info.json')) as f:
+            return json.load(f)
+
+    # Entries written before the files were stored by content have no list
+    # of files
+    def has_entry(self, key):
+        return os.path.exists(self.get_path(key, 'info.json')) and 'files' in self.read_info(key)
+
+    def get_objects(self, info):
+        return {f['object']: f['size'] for f in info['files'] if 'object' in f}
+
+    # Add the file to the store, with the prefix replaced by a placeholder in
+    # text files that refer to it
+    def add_object(self, path, prefix):
+        import uuid
+        executable = os.stat(path).st_mode & 0o111 != 0
+        tmp = self.get_path('objects', 'tmp-' + uuid.uuid4().hex)
+        m = hashlib.sha256()
+        relocate = False
+        with open(path, 'rb') as fin:
+            with open(tmp, 'wb') as fout:
+                if is_text_file(path):
+                    content = fin.read()
+                    relocate = prefix.encode('utf-8') in content
+                    chunks = [content.replace(prefix.encode('utf-8'), prefix_placeholder.encode('utf-8'))]
+                else:
+                    chunks = iter(lambda: fin.read(1 << 20), b'')
+                for chunk in chunks:
+                    m.update(chunk)
+                    fout.write(chunk)
+        name = m.hexdigest() + ('-x' if executable else '')
+        self.add_object_file(name, tmp)
+        return name, relocate
+
+    def add_object_file(self, name, tmp):
+        obj = self.get_object(name)
+        if not os.path.exists(obj):
+            mkdir(os.path.dirname(obj))
+            os.chmod(tmp, self.get_object_mode(name) & 0o555)
+            try:
+                os.replace(tmp, obj)
+                return
+            except OSError:
+                # Another process stored the same file
+                if not os.path.exists(obj):
+                    raise
+        remove_file(tmp)
+
+    # Restore the packages for key into the unlink directory of the prefix so
+    # that cget links them in instead of building them
+    def restore(self, key, prefix):
+        if not self.has_entry(key):
+            return False
+        prefix = abspath(prefix)
+        info = self.read_info(key)
+        if not is_safe_info(info):
+            raise RuntimeError('Unsafe path in cache entry ' + key)
+        if not all(os.path.exists(self.get_object(name)) for name in self.get_objects(info)):
+            # The files were removed by a gc running at the same time as the
+            # entry was stored
+            delete_dir(self.get_path(key))
+            return False
+        packages = [pkg for pkg in info['packages'] if not os.path.exists(os.path.join(prefix, 'cget', 'pkg', pkg))]
+        for pkg in packages:
+            delete_dir(os.path.join(prefix, 'cget', 'unlink', pkg))
+        unlink = os.path.realpath(mkdir(os.path.join(prefix, 'cget', 'unlink')))
+        # Links restored before could otherwise send the files after them
+        # anywhere
+        def check(p, parent):
+            if not is_subpath(os.path.realpath(p), parent):
+                for pkg in packages:
+                    delete_dir(os.path.join(prefix, 'cget', 'unlink', pkg))
+                raise RuntimeError('Cache entry {} has a path outside of {}: {}'.format(key, parent, p))
+        for f in info['files']:
+            if f['path'].split('/')[0] not in packages:
+                continue
+            dst = os.path.join(prefix, 'cget', 'unlink', *f['path'].split('/'))
+            check(os.path.dirname(dst), unlink)
+            mkdir(os.path.dirname(dst))
+            if 'dir' in f:
+                check(dst, unlink)
+                mkdir(dst)
+            elif 'link' in f:
+                os.symlink(f['link'].replace(prefix_placeholder, prefix), dst)
+                check(dst, os.path.realpath(prefix))
+            elif f['relocate']:
+                with open(self.get_object(f['object']), 'rb') as fin:
+                    content = fin.read()
+                with open(dst, 'wb') as fout:
+                    fout.write(content.replace(prefix_placeholder.encode('utf-8'), prefix.encode('utf-8')))
+                os.chmod(dst, self.get_object_mode(f['object']))
+            else:
+                materialize(self.get_object(f['object']), dst, self.get_object_mode(f['object']), link=self.link)
+        os.utime(self.get_path(key), None)
+        return True
+
+    def store(self, key, prefix, fname):
+        import uuid
+        if self.has_entry(key):
+            return
+        delete_dir(self.get_path(key))
+        prefix = abspath(prefix)
+        pkg_dir = os.path.join(prefix, 'cget', 'pkg')
+        tmp = self.get_path('tmp-' + uuid.uuid4().hex)
+        packages = get_cget_pkg_closure(prefix, fname)
+        files = []
+        try:
+            mkdir(self.get_path('objects'))
+            for pkg in packages:
+                for root, dirs, names in os.walk(os.path.join(pkg_dir, pkg)):
+                    dirs.sort()
+                    for name in sorted(dirs + names):
+                        p = os.path.join(root, name)
+                        path = os.path.relpath(p, pkg_dir).replace(os.sep, '/')
+                        if os.path.islink(p):
+                            files.append({'path': path, 'link': os.readlink(p).replace(prefix, prefix_placeholder)})
+                        elif os.path.isdir(p):
+                            files.append({'path': path, 'dir': True})
+                        else:
+                            obj, relocate = self.add_object(p, prefix)
+                            files.append({'path': path, 'object': obj, 'size': os.path.getsize(p), 'relocate': relocate})
+            # Links out of the prefix would not be restored
+            if not is_safe_info({'packages': packages, 'files': files}):
+                return
+            mkdir(tmp)
+            with open(os.path.join(tmp, 'info.json'), 'w') as f:
+                json.dump({'prefix': prefix, 'packages': packages, 'files': files, 'size': sum(x.get('size', 0) for x in files)}, f)
+            os.rename(tmp, self.get_path(key))
+        except OSError:
+            delete_dir(tmp)
+        self.evict()
+
+    def get_entries(self):
+        entries = []
+        for key in os.listdir(self.path):
+            if key == 'objects' or key.startswith('tmp-') or not self.has_entry(key):
+                continue
+            entries.append((os.path.getmtime(self.get_path(key)), key, self.get_objects(self.read_info(key))))
+        return entries
+
+    # Remove the least recently used entries until the files they refer to
+    # fit in max_size, returning the number of bytes freed
+    def evict(self):
+        entries = self.get_entries()
+        refs = collections.Counter(name for _, _, objects in entries for name in objects)
+        sizes = {name: size for _, _, objects in entries for name, size in objects.items()}
+        total = sum(sizes.values())
+        for _, key, objects in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(self.get_path(key), ignore_errors=True)
+            for name in objects:
+                refs[name] -= 1
+                if refs[name] == 0:
+                    total -= sizes[name]
+        return self.gc()
+
+    # Remove the stored files that no entry refers to, along with old entries
+    # and temporary files left by interrupted runs, returning the number of
+    # bytes freed
+    def gc(self):
+        referenced = set()
+        freed = 0
+        stale = time.time() - 24 * 60 * 60
+        for key in os.listdir(self.path):
+            p = self.get_path(key)
+            if key == 'objects' or not os.path.isdir(p):
+                continue
+            if key.startswith('tmp-'):
+                if os.path.getmtime(p) < stale:
+                    freed += get_dir_size(p)
+                    delete_dir(p)
+            elif self.has_entry(key):
+                referenced.update(self.get_objects(self.read_info(key)))
+            elif os.path.exists(self.get_path(key, 'info.json')):
+                freed += get_dir_size(p)
+                delete_dir(p)
+        for root, dirs, files in os.walk(self.get_path('objects')):
+            for file in files:
+                f = os.path.join(root, file)
+                name = os.path.basename(root) + file
+                if file.startswith('tmp-'):
+                    if os.path.getmtime(f) >= stale:
+                        continue
+                elif name in referenced:
+                    continue
+                freed += os.path.getsize(f)
+                remove_file(f)
+        return freed
+
+    # Write the entry for key with the files it refers to as a gzip
+    # compressed tar stream
+    def pack(self, key, f):
+        import gzip
+        import tarfile
+        with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) as z:
+            with tarfile.open(fileobj=z, mode='w|') as tar:
+                tar.add(self.get_path(key, 'info.json'), arcname='info.json')
+                for name in sorted(self.get_objects(self.read_info(key))):
+                    tar.add(self.get_object(name), arcname='objects/' + name)
+
+    def unpack(self, key, f):
+        import tarfile
+        import uuid
+        if self.has_entry(key):
+            return
+        tmp = self.get_path('tmp-' + uuid.uuid4().hex)
+        try:
+            with tarfile.open(fileobj=f, mode='r|gz') as tar:
+                for member in tar:
+                    if not is_cache_member(member):
+                        raise RuntimeError('Unsafe path in cache archive: ' + member.name)
+                    # Written directly rather than extracted, so nothing in the
+                    # archive can create or follow a link
+                    dst = os.path.join(tmp, *member.name.split('/'))
+                    mkdir(os.path.dirname(dst))
+                    with open(dst, 'xb') as fout:
+                        shutil.copyfileobj(tar.extractfile(member), fout)
+            if not os.path.exists(os.path.join(tmp, 'info.json')):
+                raise RuntimeError('Cache archive is missing info.json')
+            with open(os.path.join(tmp, 'info.json')) as fin:
+                info = json.load(fin)
+            if not is_safe_info(info) or not all(is_object_name(name) for name in self.get_objects(info)):
+                raise RuntimeError('Unsafe path in cache archive')
+            for name in self.get_objects(info):
+                self.add_object_file(name, os.path.join(tmp, 'objects', name))
+            delete_dir(os.path.join(tmp, 'objects'))
+            os.rename(tmp, self.get_path(key))
+        except OSError:
+            # Another process may have unpacked the same entry
+            if not self.has_entry(key):
+                raise
+        finally:
+            delete_dir(tmp)
+        self.evict()
+
+def is_safe_info(info):
+    packages = info['packages']
+    return all(pkg and '/' not in pkg and is_safe_path(pkg) for pkg in packages) and \
+        all(is_safe_path(f['path']) and f['path'].split('/')[0] in packages and ('link' not in f or is_safe_link(f['path'], f['link'])) for f in info['files'])
+
+# An archive made by pack only has info.json and regular files in objects
+def is_cache_member(member):
+    if not member.isfile():
+        return False
+    parts = member.name.split('/')
+    return parts == ['info.json'] or (len(parts) == 2 and parts[0] == 'objects' and is_object_name(parts[1]))
+
+# Cache backend that is a directory, which can be shared over NFS
+class DirectoryBackend:
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.path, name))
+
+    @contextlib.contextmanager
+    def get(self, name):
+        if not self.exists(name):
+            yield None
+        else:
+            with open(os.path.join(self.path, name), 'rb') as f:
+                yield f
+
+    def put(self, name, write):
+        import uuid
+        mkdir(self.path)
+        tmp = os.path.join(self.path, 'tmp-{}-{}'.format(uuid.uuid4().hex, name))
+        try:
+            with open(tmp, 'wb') as f:
+                write(f)
+            os.replace(tmp, os.path.join(self.path, name))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+# Cache backend that is a http server that supports GET, HEAD and PUT
+class HttpBackend:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, name, method='GET', **kwargs):
+        import urllib.request
+        return urllib.request.urlopen(urllib.request.Request(self.url + '/' + name, method=method, **kwargs))
+
+    def exists(self, name):
+        import urllib.error
+        try:
+            self.request(name, method='HEAD').close()
+            return True
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return False
+            raise
+
+    @contextlib.contextmanager
+    def get(self, name):
+        import urllib.error
+        try:
+            response = self.request(name)
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                yield None
+                return
+            raise
+        with response:
+            yield response
+
+    def put(self, name, write):
+        import tempfile
+        # The archive is spooled to a file so its length is known
+        with tempfile.TemporaryFile() as f:
+            write(f)
+            size = f.tell()
+            f.seek(0)
+            self.request(name, method='PUT', data=f, headers={'Content-Length': str(size), 'Content-Type': 'application/gzip'}).close()
+
+def get_remote_backend(url):
+    if url.startswith(('http://', 'https://')):
+        return HttpBackend(url)
+    if url.startswith('file://'):
+        return DirectoryBackend(url[len('file://'):])
+    return DirectoryBackend(abspath(os.path.expanduser(url)))
+
+# Shares the entries of the local cache with other machines through a backend
+class RemoteCache:
+    def __init__(self, backend, cache, push=True):
+        self.backend = backend
+        self.cache = cache
+        self.push = push
+
+    def get_name(self, remote_key):
+        return remote_key + '.tar.gz'
+
+    def fetch(self, key, remote_key):
+        if self.cache.has_entry(key):
+            return True
+        try:
+            with self.backend.get(self.get_name(remote_key)) as f:
+                if f is None:
+                    return False
+                self.cache.unpack(key, f)
+            return True
+        except Exception as e:
+            click.echo('Failed to fetch {} from the remote cache: {}'.format(remote_key, e))
+            return False
+
+    def store(self, key, remote_key):
+        if not self.push or not self.cache.has_entry(key):
+            return
+        try:
+            if not self.backend.exists(self.get_name(remote_key)):
+                self.backend.put(self.get_name(remote_key), lambda f: self.cache.pack(key, f))
+        except Exception as e:
+            click.echo('Failed to push {} to the remote cache: {}'.format(remote_key, e))
+
+# Lines of the requirements.txt in the top directory of a source archive
+def read_archive_requirements(f):
+    import tarfile
+    import zipfile
+    if zipfile.is_zipfile(f):
+        with zipfile.ZipFile(f) as z:
+            names = {posixpath.normpath(name): name for name in z.namelist() if not name.endswith('/')}
+            return expand_archive_requirements(names, lambda name: z.read(names[name]))
+    elif tarfile.is_tarfile(f):
+        with tarfile.open(f) as t:
+            members = {posixpath.normpath(m.name): m for m in t.getmembers() if m.isfile()}
+            return expand_archive_requirements(members, lambda name: t.extractfile(members[name]).read())
+    return []
+
+# Lines of the top-level requirements.txt in an archive, with the files it
+# includes with -f read from the archive as cget would
+def expand_archive_requirements(names, read):
+    def expand(name, parents):
+        result = []
+        for line in read(name).decode('utf-8').splitlines():
+            tokens = shlex.split(line, comments=True)
+            if tokens and tokens[0] in ['-f', '--file']:
+                include = posixpath.normpath(posixpath.join(posixpath.dirname(name), tokens[1]))
+                if include in parents:
+                    raise RuntimeError('Recursive requirements file: ' + ' -> '.join(parents + [include]))
+                if include not in names:
+                    raise RuntimeError('{} includes {} which is not in the archive'.format(name, tokens[1]))
+                result.extend(expand(include, parents + [include]))
+            else:
+                result.append(line)
+        return result
+    for name in names:
+        if len(name.split('/')) == 2 and name.endswith('/requirements.txt'):
+            return expand(name, [name])
+    return []
+
+# Sources of the dependencies downloaded ahead of installing them, so they can
+# be installed without the network. The index maps each url to its archive,
+# digest and the requirements found in it.
+class Mirror:
+    def __init__(self, path, recipe_paths=None):
+        self.path = abspath(os.path.expanduser(path))
+        self.recipe_paths = recipe_paths or []
+        self.index = JsonFileCache(os.path.join(self.path, 'index.json'))
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        entry = self.index.entries.get(url)
+        if entry and os.path.exists(os.path.join(self.path, entry['file'])):
+            return entry
+        return None
+
+    def download(self, url, digest=None):
+        import urllib.request
+        entry = self.get(url)
+        if entry:
+            return entry
+        mkdir(self.path)
+        tmp = os.path.join(self.path, '.tmp.{}.{}'.format(os.getpid(), threading.get_ident()))
+        m = hashlib.sha256()
+        expected = hashlib.new(digest.lower().split(':')[0]) if digest else None
+        try:
+            with contextlib.closing(urllib.request.urlopen(url)) as src, open(tmp, 'wb') as dst:
+                for chunk in iter(lambda: src.read(1 << 20), b''):
+                    m.update(chunk)
+                    if expected: expected.update(chunk)
+                    dst.write(chunk)
+            if expected and expected.hexdigest() != digest.lower().split(':')[1]:
+                raise RuntimeError("Hash doesn't match for {}: {}".format(url, digest))
+            ext = first(re.findall(r'(\.tar\.\w+|\.tgz|\.tar|\.zip)$', url.split('?')[0]), '')
+            entry = {'file': m.hexdigest() + ext, 'digest': 'sha256:' + m.hexdigest(), 'requires': read_archive_requirements(tmp)}
+            os.replace(tmp, os.path.join(self.path, entry['file']))
+            click.echo('Fetched {}'.format(url))
+        finally:
+            if os.path.exists(tmp):
+                remove_file(tmp)
+        with self.lock:
+            self.index.entries[url] = entry
+            self.index.changed = True
+            self.index.save()
+        return entry
+
+    # Download the sources of a requirement and of the requirements in them
+    def fetch(self, req, ignore=None, seen=None):
+        seen = set() if seen is None else seen
+        url = get_source_url(req)
+        # Recipes are installed from the sources their package.txt points to
+        if url is None or url in seen or get_recipe(req, self.recipe_paths):
+            return
+        seen.add(url)
+        entry = self.download(url, get_req_digest(req.tokens))
+        for dep in self.get_requires(entry, ignore):
+            self.fetch(dep, ignore, seen)
+
+    # Names of the requirements in the sources of a requirement, or None when
+    # they are not in the mirror
+    def get_required_names(self, req, ignore=None):
+        url = get_source_url(req)
+        entry = self.get(url) if url and not get_recipe(req, self.recipe_paths) else None
+        if entry is None:
+            return None
+        if '--ignore-requirements' in req.tokens:
+            return []
+        return [dep.name() for dep in self.get_requires(entry, ignore)]
+
+    def get_requires(self, entry, ignore=None):
+        lines = list(split_lines(entry['requires']))
+        if any(tokens[0] in ['-f', '--file'] for tokens in lines):
+            raise RuntimeError('{} in the mirror {} includes requirements files that were not read'.format(entry['file'], self.path))
+        return list(parse_req_tokens(lines, ignore=ignore))
+
+    # Requirements lines that install a requirement from the mirror, preceded
+    # by the requirements in its sources so cget finds them already installed.
+    # Anything the mirror can't serve is left to cget to download, unless
+    # offline where it would need the network.
+    def get_install_tokens(self, req, ignore=None, offline=False, seen=None):
+        seen = set() if seen is None else seen
+        url = get_source_url(req)
+        if url is None:
+            return [req.resolved_tokens()]
+        if url in seen:
+            return []
+        seen.add(url)
+        recipe = get_recipe(req, self.recipe_paths)
+        entry = None if recipe else self.get(url)
+        if entry is None:
+            if recipe and offline:
+                raise RuntimeError('{} is installed with the recipe {} which can not be installed offline'.format(req.line(), recipe))
+            if offline:
+                raise RuntimeError('{} is not in the mirror {}, run rbuild fetch first'.format(url, self.path))
+            return [req.resolved_tokens()]
+        result = []
+        if '--ignore-requirements' not in req.tokens:
+            for dep in self.get_requires(entry, ignore):
+                result.extend(self.get_install_tokens(dep, ignore, offline, seen))
+        # Named after the package cget would install so it is the same package
+        tokens = req.resolved_tokens()
+        tokens[tokens.index(req.package())] = get_cget_fname(req) + ',' + os.path.join(self.path, entry['file'])
+        return result + [tokens]
+
+# Wakes up on changes to the watched directories using inotify on linux
+class Inotify:
+    # IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO,
+    # IN_CREATE, IN_DELETE, IN_DELETE_SELF and IN_MOVE_SELF
+    mask = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = set()
+
+    def watch(self, dirs):
+        import ctypes
+        # Watches of removed directories are dropped by the kernel
+        self.dirs &= dirs
+        for d in dirs - self.dirs:
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(d), self.mask) < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for ' + d)
+            self.dirs.add(d)
+
+    def wait(self, timeout=None):
+        import select
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            os.read(self.fd, 1 << 16)
+
+    def close(self):
+        os.close(self.fd)
+
+# Watches files for changes by comparing their mtime and size, waking up
+# with inotify where it is available and polling otherwise
+class Watcher:
+    def __init__(self, paths, ignore=None, interval=1.0, poll=False):
+        self.paths = [abspath(p) for p in paths]
+        self.ignore = [abspath(p) for p in ignore or []]
+        self.interval = interval
+        self.inotify = None
+        if not poll and sys.platform.startswith('linux'):
+            try:
+                self.inotify = Inotify()
+            except (AttributeError, OSError):
+                self.inotify = None
+        self.snapshot = self.scan()
+
+    def is_ignored(self, path):
+        return os.path.basename(path) in ignore_fingerprint_dirs or any(path == p or path.startswith(p + os.sep) for p in self.ignore)
+
+    def scan(self):
+        snapshot = {}
+        dirs = set()
+        for path in self.paths:
+            if os.path.isfile(path):
+                st = os.stat(path)
+                snapshot[path] = (st.st_mtime_ns, st.st_size)
+                dirs.add(os.path.dirname(path))
+            for root, ds, files in os.walk(path):
+                ds[:] = [d for d in ds if not self.is_ignored(os.path.join(root, d))]
+                dirs.add(root)
+                for file in files:
+                    f = os.path.join(root, file)
+                    try:
+                        st = os.stat(f)
+                    except OSError:
+                        continue
+                    snapshot[f] = (st.st_mtime_ns, st.st_size)
+        if self.inotify:
+            try:
+                self.inotify.watch(dirs)
+            except OSError as e:
+                click.echo('Watching by polling instead: {}'.format(e))
+                self.inotify.close()
+                self.inotify = None
+        return snapshot
+
+    def sleep(self):
+        if self.inotify:
+            self.inotify.wait()
+        else:
+            time.sleep(self.interval)
+
+    # Wait for files to change, and then until they stop changing for the
+    # debounce time, returning the files that changed
+    def wait(self, debounce=0.3):
+        changed = set()
+        while not changed:
+            self.sleep()
+            snapshot = self.scan()
+            changed = get_changed_files(self.snapshot, snapshot)
+            self.snapshot = snapshot
+        while True:
+            time.sleep(debounce)
+            if self.inotify:
+                self.inotify.wait(0)
+            snapshot = self.scan()
+            more = get_changed_files(self.snapshot, snapshot)
+            self.snapshot = snapshot
+            if not more:
+                return sorted(changed)
+            changed |= more
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+
+def get_changed_files(before, after):
+    return set(f for f in set(before) | set(after) if before.get(f) != after.get(f))
+
+def is_cmake_input(path):
+    name = os.path.basename(path)
+    return name == 'CMakeLists.txt' or name.endswith(('.cmake', '.cmake.in'))
+
+def in_phase(name):
+    def wrap(f):
+        @functools.wraps(f)
+        def w(self, *args, **kwargs):
+            with self.phase(name):
+                return f(self, *args, **kwargs)
+        return w
+    return wrap
+
+# Options of a session merged over the defaults, which rbuild.ini can refer
+# to, and under the variant and the flags
+def get_builder_options(session, source_dir=None, variant=None, flags=None):
+    flags = flags or {}
+    # Default options
+    default_options = {
+        'deps_dir': abspath(flags.get('deps_dir', os.path.join(os.getcwd(), 'deps'))),
+        'source_dir': source_dir or os.getcwd(),
+        'build_dir': abspath(flags.get('build_dir', os.path.join(os.getcwd(), 'build'))),
+        'global_define': [],
+        'define': [],
+        'ignore': [],
+        'deps': [],
+        'cache_dir': get_cache_dir(),
+        'cache_size': os.environ.get('RBUILD_CACHE_SIZE', '10G')
+    }
+    if os.environ.get('RBUILD_REMOTE_CACHE'):
+        default_options['remote_cache'] = os.environ['RBUILD_REMOTE_CACHE']
+    if os.environ.get('RBUILD_MIRROR'):
+        default_options['mirror'] = os.environ['RBUILD_MIRROR']
+    # Searching for rocm is only needed when the ini file refers to it
+    if 'rocm_path' in '\n'.join(read_from(os.path.join(default_options['source_dir'], 'rbuild.ini'))):
+        default_options['rocm_path'] = get_rocm_path()
+    session_options = get_config_cache().get_session_options(session or 'default', defaults=default_options)
+    return merge(default_options, session_options, variant or {}, flags, append=['define', 'global_define'])
+
+def get_cache_file(options, name):
+    cache_dir = options.get('cache_dir')
+    if cache_dir and cache_dir.lower() != 'none':
+        return os.path.join(abspath(os.path.expanduser(cache_dir)), name)
+    return None
+
+def read_lock_file(f):
+    if not os.path.exists(f):
+        return {}
+    with open(f) as lock:
+        return json.load(lock)
+
+# Replace the requirements with the pinned ones from rbuild.lock
+def pin_requirements(reqs, lock):
+    locked = lock.get('requirements', {})
+    for req in reqs:
+        entry = locked.get(req.line())
+        yield Requirement(entry['tokens'], req.start) if entry else req
+
+# Requirements of the resolved options, pinned to rbuild.lock unless locked
+# is false
+def read_requirements(options, cache=None, lock=None, locked=True):
+    source_dir = options['source_dir']
+    reqs = parse_reqs(options['deps'], path=os.path.join(source_dir, 'rbuild.ini'), ignore=options['ignore'], cache=cache)
+    if not locked:
+        return list(reqs)
+    return list(pin_requirements(reqs, read_lock_file(os.path.join(source_dir, 'rbuild.lock')) if lock is None else lock))
+
+# Requirement line followed by the digests of the local files it refers to
+def get_req_content(req, fingerprints):
+    return [req.line()] + [fingerprints.hash_path(f) for f in req.local_files()]
+
+def compute_reqs_hash(reqs, fingerprints):
+    return compute_md5(x for req in reqs for x in get_req_content(req, fingerprints))
+
+def save_caches(options, *caches):
+    for cache in caches:
+        cache.save()
+    if get_cache_file(options, 'config.json'):
+        get_config_cache().save()
+
 class Builder:
-    def __init__(self, session, source_dir=None, **kwargs):
+    def __init__(self, session, source_dir=None, tracer=None, variant=None, **kwargs):
         flags = remove_empty_values(kwargs)
-        # Default options
-        default_options = {
-            'deps_dir': abspath(flags.get('deps_dir', os.path.join(os.getcwd(), 'deps'))),
-            'source_dir': source_dir or os.getcwd(),
-            'build_dir': abspath(flags.get('build_dir', os.path.join(os.getcwd(), 'build'))),
-            'global_define': [],
-            'define': [],
-            'ignore': [],
-            'deps': [],
-            'rocm_path': get_rocm_path()
-        }
-        session_options = get_session_options(session or 'default', defaults=default_options)
-        self.options = merge(default_options, session_options, flags, append=['define', 'global_define'])
+        self.options = get_builder_options(session, source_dir, variant, flags)
         self.explicit_define = flags.get('define', [])
+        self.fingerprints = None
+        self.requirements_cache = None
+        self.compiler_hash = None
+        self.lock = None
+        self.tracer = tracer or Tracer()
+        self.current_phase = None
 
 
     def get_prefix(self):
@@ -219,13 +1902,91 @@ class Builder:
     def get_generator(self):
         return self.options.get('generator', None)
 
+    def get_build_type(self):
+        return self.options.get('build_type', None)
+
+    def get_jobs(self):
+        jobs = str(self.options.get('jobs', 'auto'))
+        if jobs == 'auto':
+            return get_auto_jobs(parse_size(self.options.get('job_memory', '2G')))
+        return max(1, int(jobs))
+
+    def get_install_jobs(self):
+        return max(1, int(self.options.get('install_jobs', 1)))
+
+    # cget runs make with -j set to the number of cpus, which only python 3.13
+    # and later let PYTHON_CPU_COUNT change, so the jobs can only be shared
+    # between dependencies installed at the same time when they use ninja,
+    # which follows CMAKE_BUILD_PARALLEL_LEVEL
+    def can_share_cget_jobs(self):
+        return 'ninja' in (self.get_generator() or '').lower()
+
+    # Environment to limit the parallelism of the builds done by cget
+    def get_cget_env(self, jobs):
+        env = dict(os.environ)
+        env['CMAKE_BUILD_PARALLEL_LEVEL'] = str(jobs)
+        env['PYTHON_CPU_COUNT'] = str(jobs)
+        return env
+
     def get_hash_file(self):
         return os.path.join(self.get_prefix(), 'hash')
 
-    # TODO: Add command tracing
+    def get_rbuild_path(self, *ps):
+        return os.path.join(self.get_prefix(), 'rbuild', *ps)
+
+    def get_requirements(self, locked=True):
+        return read_requirements(self.options, cache=self.get_requirements_cache(), lock=self.read_lock(), locked=locked)
+
+    def get_lock_file(self):
+        return os.path.join(self.get_source_dir(), 'rbuild.lock')
+
+    def read_lock(self):
+        if self.lock is None:
+            self.lock = read_lock_file(self.get_lock_file())
+        return self.lock
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        previous = self.current_phase
+        self.current_phase = name
+        try:
+            with self.tracer.phase(name):
+                yield
+        finally:
+            self.current_phase = previous
+
+    def get_log_dir(self):
+        log_dir = self.options.get('log_dir')
+        if log_dir:
+            return mkdir(abspath(log_dir))
+        return None
+
+    def get_log_file(self, c):
+        if not self.get_log_dir():
+            return None
+        # Named after the run so the logs of runs sharing the directory stay apart
+        name = '{}-{:03d}-{}-{}.log.gz'.format(self.tracer.run_id, next(log_counter), self.current_phase or 'run', os.path.basename(c[0]))
+        return os.path.join(self.get_log_dir(), name)
+
     def cmd(self, c, **kwargs):
-        click.echo(' '.join(c))
-        subprocess.check_call(c, **kwargs)
+        label = get_task_label()
+        prefix = '[{}] '.format(label) if label else None
+        echo_line(' '.join(c), prefix=prefix)
+        log = self.get_log_file(c)
+        tail = collections.deque(maxlen=int(self.options.get('log_tail', 20)))
+        record = run_command(c, log=log, tail=tail, prefix=prefix, **kwargs)
+        record['phase'] = self.current_phase
+        if label:
+            record['task'] = label
+        self.tracer.add(record)
+        if log and record['exit_code'] != 0:
+            echo_log(log, prefix=prefix)
+        elif log:
+            echo_lines(tail, prefix=prefix)
+        if log:
+            echo_line('Log written to ' + log, prefix=prefix)
+        if record['exit_code'] != 0:
+            raise subprocess.CalledProcessError(record['exit_code'], c)
 
     def cget(self, *args, **kwargs):
         self.cmd(['cget', '-p', self.get_prefix()] + list(args), **kwargs)
@@ -234,61 +1995,578 @@ class Builder:
         self.cmd(['cmake'] + sanitize_cmake_args(list(args)), **kwargs)
 
     def is_make_generator(self):
-        return os.path.exists(self.get_build_path('Makefile'))
+        return os.path.exists(os.path.join(self.get_build_dir(), 'Makefile'))
 
     def make(self, target, build='.'):
-        args = ['--build', build, '--config', 'Release']
-        if target != 'all':
-            args = args + ['--target', target]
-        if os.path.exists(os.path.join(build, 'Makefile')):
-            args = args + ['--', '-j' + str(multiprocessing.cpu_count())]
+        targets = target if isinstance(target, list) else [target]
+        args = ['--build', build, '--config', self.get_build_type() or 'Release']
+        if targets != ['all']:
+            args = args + ['--target'] + targets
+        if any(os.path.exists(os.path.join(build, f)) for f in ['Makefile', 'build.ninja']):
+            args = args + ['--', '-j' + str(self.get_jobs())]
         self.cmake(*args)
 
+    def get_cache_file(self, name):
+        return get_cache_file(self.options, name)
+
+    def get_fingerprints(self):
+        if self.fingerprints is None:
+            self.fingerprints = Fingerprints(self.get_cache_file('fingerprints.json'))
+        return self.fingerprints
+
+    def get_requirements_cache(self):
+        if self.requirements_cache is None:
+            self.requirements_cache = RequirementsCache(self.get_cache_file('requirements.json'))
+        return self.requirements_cache
+
+    def save_caches(self):
+        save_caches(self.options, self.get_fingerprints(), self.get_requirements_cache())
+
+    def get_req_content(self, req):
+        return get_req_content(req, self.get_fingerprints())
+
     def compute_hash(self):
-        return compute_md5(read_reqs(self.get_deps(), path=os.path.join(os.getcwd(), 'rbuild.ini'), ignore=self.get_ignore()))
+        h = compute_reqs_hash(self.get_requirements(), self.get_fingerprints())
+        self.save_caches()
+        return h
 
     def hash_matches(self, h):
         if first(read_from(self.get_hash_file()), '').strip() == h:
             return True
         return False
 
-    def prepare(self, init_with_define_flag=False):
-        h = self.compute_hash()
-        if os.path.exists(self.get_hash_file()):
-            if self.hash_matches(h):
-                return
+    def get_cache(self):
+        cache_dir = self.options.get('cache_dir')
+        if not cache_dir or cache_dir.lower() == 'none':
+            return None
+        try:
+            path = mkdir(abspath(os.path.expanduser(cache_dir)))
+        except OSError as e:
+            click.echo('Not using the cache in {}: {}'.format(cache_dir, e))
+            return None
+        return DepCache(path, parse_size(self.options.get('cache_size', '10G')), link=self.options.get('cache_link', 'auto'))
 
-        cg = self.cget
-        cg('clean', '-y')
+    def get_remote_cache(self, cache):
+        url = self.options.get('remote_cache')
+        if not url or url.lower() == 'none' or cache is None:
+            return None
+        push = str(self.options.get('remote_cache_push', 'on')).lower() not in ['off', 'no', 'false', '0']
+        return RemoteCache(get_remote_backend(url), cache, push=push)
+
+    def get_mirror(self):
+        path = self.options.get('mirror')
+        if not path or path.lower() == 'none':
+            return None
+        return Mirror(path, [os.path.join(self.get_prefix(), 'etc', 'cget', 'recipes')])
+
+    def is_offline(self):
+        return str(self.options.get('offline', 'off')).lower() in ['on', 'yes', 'true', '1']
+
+    def get_compiler_hash(self):
+        if self.compiler_hash is None:
+            cxx = self.options.get('cxx') or os.environ.get('CXX') or 'c++'
+            cc = self.options.get('cc') or os.environ.get('CC') or 'cc'
+            self.compiler_hash = compute_md5([get_compiler_identity(cxx), get_compiler_identity(cc)])
+        return self.compiler_hash
+
+    def get_manifest_file(self):
+        return self.get_rbuild_path('manifest.json')
+
+    def read_manifest(self):
+        f = self.get_manifest_file()
+        if not os.path.exists(f):
+            return {}
+        with open(f) as m:
+            return json.load(m)
+
+    # Written after every change so an interrupted prepare can resume
+    def write_manifest(self, manifest):
+        mkdir(os.path.dirname(self.get_manifest_file()))
+        tmp = '{}.{}.{}'.format(self.get_manifest_file(), os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.get_manifest_file())
+
+    # Run f again after a delay that doubles each time it fails, for errors
+    # such as a download that failed
+    def retry(self, f):
+        import urllib.error
+        retries = int(self.options.get('retries', 0))
+        delay = float(self.options.get('retry_delay', 5))
+        for attempt in range(retries + 1):
+            try:
+                return f()
+            except (subprocess.CalledProcessError, urllib.error.URLError, ConnectionError):
+                group = get_task_group()
+                if attempt == retries or (group and group.cancelled):
+                    raise
+                click.echo('Retrying in {:.0f}s ({} of {})'.format(delay * 2 ** attempt, attempt + 1, retries))
+                time.sleep(delay * 2 ** attempt)
+
+    def get_init_args(self):
         args = {}
         for option in ['cxx', 'cc', 'toolchain', 'std']:
             if option in self.options:
                 args[option] = self.options[option]
-        defines = self.options['global_define']
-        if init_with_define_flag:
-            defines = list(defines) + list(self.explicit_define)
-        cg('init', *make_args(define=defines, **args))
+        return args
+
+    def get_toolchain_hash(self):
+        return compute_md5([json.dumps(self.get_init_args(), sort_keys=True)] + list(self.options['global_define']))
+
+    def get_dep_hash(self, req):
+        return compute_md5([self.get_toolchain_hash(), self.get_generator() or '', ' '.join(req.resolved_tokens())] + self.get_req_content(req)[1:])
+
+    def get_dep_key(self, req):
+        return req.name() or req.line()
+
+    @in_phase('prepare')
+    def prepare(self, init_with_define_flag=False, shard=None):
+        import concurrent.futures
+        h = self.compute_hash()
+        manifest = self.read_manifest()
+        if not manifest and os.path.exists(self.get_hash_file()):
+            if self.hash_matches(h):
+                return
+
+        cg = self.cget
+        init_define = list(self.explicit_define) if init_with_define_flag else manifest.get('init_define', [])
+        # The dependencies are built again when the compiler changes, even
+        # when it is called the same
+        toolchain = compute_md5([self.get_toolchain_hash(), self.get_compiler_hash()])
+        if manifest.get('toolchain') != toolchain or manifest.get('init_define') != init_define:
+            cg('clean', '-y')
+            cg('init', *make_args(define=get_launcher_defines(self.get_compiler_launcher()) + list(self.options['global_define']) + init_define, **self.get_init_args()))
+            for dep in self.get_ignore():
+                cg('ignore', dep)
+            manifest = {'toolchain': toolchain, 'init_define': init_define, 'deps': {}}
+            self.write_manifest(manifest)
+
+        installed = manifest['deps']
+        reqs = self.get_requirements()
+        mirror = self.get_mirror()
+        graph = get_req_graph(reqs, ignore=self.get_ignore(), mirror=mirror)
+        if shard:
+            # Each shard is installed into its own prefix, so only the known
+            # requirements have to be in the same shard. The ones with unknown
+            # requirements are built without the other shards, so they are
+            # hashed with only what is in their shard.
+            keys = get_shards(get_req_graph(reqs, unknown=False, ignore=self.get_ignore(), mirror=mirror), shard[1])[shard[0] - 1]
+            graph = {i: [j for j in graph[i] if j in keys] for i in keys}
+        # A dependency is reinstalled when one it was built against changes
+        hashes = []
+        for i, req in enumerate(reqs):
+            hashes.append(compute_md5([self.get_dep_hash(req)] + [hashes[j] for j in graph.get(i, [])]))
+        current = {self.get_dep_key(req): hashes[i] for i, req in enumerate(reqs)}
+        cache_keys = [compute_md5([current[self.get_dep_key(req)], self.get_compiler_hash()] + init_define) for req in reqs]
+        self.save_caches()
+        for key, dep in list(installed.items()):
+            if current.get(key) != dep['hash']:
+                cg('remove', '-y', dep['package'])
+                del installed[key]
+                self.write_manifest(manifest)
 
-        for dep in self.get_ignore():
-            cg('ignore', dep)
         generator_args = ['-G', self.get_generator()] if self.get_generator() else []
-        for dep in self.get_deps():
-            tokens = shlex.split(dep, comments=True)
-            cg('install', *generator_args, *tokens, cwd=self.get_source_dir())
-        write_to(self.get_hash_file(), [h])
+        cache = self.get_cache()
+        install_jobs = self.get_install_jobs()
+        if self.can_share_cget_jobs():
+            cget_env = self.get_cget_env(max(1, self.get_jobs() // install_jobs))
+        else:
+            cget_env = self.get_cget_env(self.get_jobs())
+            if install_jobs > 1 and len(graph) > 1:
+                click.echo('Warning: cget builds each dependency with make using every cpu, so installing {} at a time can run {} times as many jobs as there are cpus. Use the Ninja generator to share the jobs between them.'.format(install_jobs, install_jobs))
+        lock = threading.Lock()
+        remote = self.get_remote_cache(cache)
+        if remote:
+            # The cache keys already have the compiler, so they can be shared
+            # between machines
+            remote_keys = cache_keys
+            missing = [i for i in graph if self.get_dep_key(reqs[i]) not in installed]
+            # Download everything that is missing up front, several at a time
+            run_graph({i: [] for i in missing}, lambda i: remote.fetch(cache_keys[i], remote_keys[i]), jobs=8)
+        offline = self.is_offline()
+        if offline and mirror is None:
+            raise RuntimeError('Installing offline needs a mirror, set with --mirror')
+        downloads = {}
+        if mirror and not offline:
+            # Download the sources in the background while the dependencies
+            # before them are built
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+            for i in graph:
+                if self.get_dep_key(reqs[i]) not in installed:
+                    downloads[i] = executor.submit(mirror.fetch, reqs[i], self.get_ignore())
+        def install(i):
+            key = self.get_dep_key(reqs[i])
+            if key in installed:
+                return
+            start = time.time()
+            tokens = reqs[i].resolved_tokens()
+            f = self.get_rbuild_path('requirements', str(i) + '.txt')
+            mkdir(os.path.dirname(f))
+            lines = [tokens]
+            cache_key = cache_keys[i]
+            restored = cache is not None and cache.restore(cache_key, self.get_prefix())
+            if restored:
+                click.echo('Restored {} from cache'.format(reqs[i].line()))
+            elif mirror:
+                if i in downloads:
+                    # Failed downloads are tried again below
+                    concurrent.futures.wait([downloads[i]])
+                if not offline:
+                    self.retry(lambda: mirror.fetch(reqs[i], self.get_ignore()))
+                lines = mirror.get_install_tokens(reqs[i], self.get_ignore(), offline)
+            write_to(f, [' '.join(shlex.quote(token) for token in x) for x in lines])
+            self.retry(lambda: cg('install', *generator_args, '-f', f, cwd=self.get_source_dir(), env=cget_env))
+            fname = get_cget_fname(Requirement(tokens))
+            if cache and os.path.exists(os.path.join(self.get_prefix(), 'cget', 'pkg', fname)):
+                cache.store(cache_key, self.get_prefix(), fname)
+                if remote:
+                    remote.store(cache_key, remote_keys[i])
+            with lock:
+                installed[key] = {'hash': current[key], 'package': Requirement(tokens).package()}
+                self.write_manifest(manifest)
+            self.tracer.add({'phase': 'prepare', 'dep': key, 'start': start, 'wall': time.time() - start, 'cached': restored, 'requires': [self.get_dep_key(reqs[j]) for j in graph[i]]})
+        try:
+            run_graph(graph, install, jobs=install_jobs, labels=[self.get_dep_key(req) for req in reqs])
+        finally:
+            for future in downloads.values():
+                future.cancel()
+            if downloads:
+                executor.shutdown(wait=False)
+        if not shard:
+            write_to(self.get_hash_file(), [h])
+
+    def get_toolchain_file(self):
+        return os.path.join(self.get_prefix(), 'cget', 'cget.cmake')
 
-    def configure(self, clean=True):
-        toolchain_file = os.path.join(self.get_prefix(), 'cget', 'cget.cmake')
+    def get_compiler_launcher(self):
+        return find_compiler_launcher(self.options.get('compiler_launcher'))
+
+    def get_configure_defines(self):
+        defines = get_launcher_defines(self.get_compiler_launcher())
+        if self.get_build_type():
+            defines.append('CMAKE_BUILD_TYPE=' + self.get_build_type())
+        return defines + list(self.get_defines())
+
+    # Variants that build with the same dependencies can share a prefix
+    def get_deps_hash(self):
+        return compute_md5([self.get_toolchain_hash(), self.get_generator() or '', self.compute_hash()])
+
+    def get_configure_hash_file(self):
+        return os.path.join(self.get_build_dir(), 'rbuild.hash')
+
+    def compute_configure_hash(self):
+        lines = [self.get_generator() or '', self.get_toolchain_file(), self.get_source_dir(), shutil.which('cmake') or '']
+        lines.extend(self.get_configure_defines())
+        # The installed dependencies can change what cmake finds
+        for f in [self.get_toolchain_file(), self.options.get('toolchain'), self.get_manifest_file()]:
+            if f: lines.extend(read_from(f))
+        return compute_md5(lines)
+
+    def is_configured(self, h):
+        if not os.path.exists(os.path.join(self.get_build_dir(), 'CMakeCache.txt')):
+            return False
+        return first(read_from(self.get_configure_hash_file()), '').strip() == h
+
+    @in_phase('configure')
+    def configure(self, clean=True, incremental=False):
+        h = self.compute_configure_hash()
+        if incremental and self.is_configured(h):
+            click.echo('Reusing build directory ' + self.get_build_dir())
+            return
         if clean: delete_dir(self.get_build_dir())
         mkdir(self.get_build_dir())
+        if os.path.exists(self.get_configure_hash_file()):
+            os.remove(self.get_configure_hash_file())
         generator_args = ['-G', self.get_generator()] if self.get_generator() else []
-        self.cmake(*generator_args, '-DCMAKE_TOOLCHAIN_FILE='+toolchain_file, self.get_source_dir(), *make_defines(self.get_defines()), cwd=self.get_build_dir())
+        self.cmake(*generator_args, '-DCMAKE_TOOLCHAIN_FILE='+self.get_toolchain_file(), self.get_source_dir(), *make_defines(self.get_configure_defines()), cwd=self.get_build_dir())
+        write_to(self.get_configure_hash_file(), [h])
 
+    @in_phase('build')
     def build(self, target=None):
         self.make(target or None, build=self.get_build_dir())
 
+    # Version of the cmake that configured the build directory
+    def read_cmake_cache(self):
+        cache = {}
+        for line in read_from(os.path.join(self.get_build_dir(), 'CMakeCache.txt')):
+            m = re.match(r'^([\w-]+):\w+=(.*)$', line)
+            if m:
+                cache[m.group(1)] = m.group(2)
+        return cache
+
+    def get_cmake_version(self):
+        cache = self.read_cmake_cache()
+        return tuple(int(cache.get('CMAKE_CACHE_{}_VERSION'.format(x), 0)) for x in ['MAJOR', 'MINOR'])
+
+    # Building the targets in one invocation lets make or ninja run the jobs
+    # of all of them at the same time within one -j, and build what they have
+    # in common only once, which separate builds in the same directory can't
+    # do safely
+    def build_targets(self, targets):
+        cache = self.read_cmake_cache()
+        if len(targets) > 1 and cache.get('CMAKE_GENERATOR') in ['Unix Makefiles', 'MinGW Makefiles', 'MSYS Makefiles']:
+            self.build_make_targets(targets, cache['CMAKE_MAKE_PROGRAM'])
+        elif len(targets) > 1 and self.get_cmake_version() >= (3, 15):
+            self.build(list(targets))
+        else:
+            for t in targets:
+                self.build(t)
 
-def build_command(require_deps=True, no_build_dir=False):
+    # The top level Makefile is .NOTPARALLEL, so it builds its goals one after
+    # another. It is only used to regenerate the build system, and then the
+    # targets are built from Makefile2, which has the rules of every target.
+    # Targets such as install and package are only in the top level Makefile,
+    # so they are built after the others one at a time.
+    @in_phase('build')
+    def build_make_targets(self, targets, make):
+        self.make('cmake_check_build_system', build=self.get_build_dir())
+        defined = self.get_makefile2_targets()
+        parallel = [t for t in targets if t in defined]
+        if parallel:
+            self.cmd([make, '-f', os.path.join('CMakeFiles', 'Makefile2'), '-j' + str(self.get_jobs())] + parallel, cwd=self.get_build_dir())
+        for t in targets:
+            if t not in defined:
+                self.build(t)
+
+    def get_makefile2_targets(self):
+        targets = set()
+        for line in read_from(os.path.join(self.get_build_dir(), 'CMakeFiles', 'Makefile2')):
+            m = re.match(r'^([^\s#:=$%.][^\s:=]*)\s*:(?!=)', line)
+            if m:
+                targets.add(m.group(1))
+        return targets
+
+    def get_package_generators(self):
+        return self.options.get('package_generator') or []
+
+    @in_phase('package')
+    def cpack(self, generator):
+        self.cmd(['cpack', '-G', generator, '-C', self.get_build_type() or 'Release'], cwd=self.get_build_dir())
+
+
+class BuilderFactory:
+    def __init__(self, sessions=None, tracer=None, launcher_stats=True, **flags):
+        self.sessions = list(collections.OrderedDict.fromkeys(sessions or []))
+        self.tracer = tracer
+        # Running the compiler launcher for its stats is only worth it for
+        # commands that compile
+        self.launcher_stats_enabled = launcher_stats
+        self.flags = flags
+        self.launcher_stats = collections.OrderedDict()
+
+    def make(self, session, combination=None, **kwargs):
+        b = Builder(session=session, variant=get_variant_options(combination or []), tracer=self.tracer, **merge(self.flags, kwargs))
+        launcher = b.get_compiler_launcher() if self.launcher_stats_enabled else None
+        if launcher and launcher not in self.launcher_stats:
+            self.launcher_stats[launcher] = get_launcher_stats(launcher)
+        return b
+
+    def report(self):
+        for launcher, before in self.launcher_stats.items():
+            after = get_launcher_stats(launcher)
+            if before is None or after is None:
+                continue
+            hits = after[0] - before[0]
+            misses = after[1] - before[1]
+            if self.tracer:
+                self.tracer.launchers[os.path.basename(launcher)] = [hits, misses]
+            if hits + misses > 0:
+                click.echo('{}: {} hits, {} misses ({:.1f}% hit rate)'.format(os.path.basename(launcher), hits, misses, 100.0 * hits / (hits + misses)))
+
+    def __call__(self, session=None):
+        return self.variants(session)[0]
+
+    # The hash only needs the requirements, so it is computed without setting
+    # up a builder unless there is a matrix to pick the variant from
+    def compute_hash(self, session=None):
+        flags = remove_empty_values(self.flags)
+        source_dir = flags.pop('source_dir', None)
+        options = get_builder_options((self.sessions or [session or 'try:main'])[0], source_dir, flags=flags)
+        if options.get('matrix'):
+            return self(session).compute_hash()
+        fingerprints = Fingerprints(get_cache_file(options, 'fingerprints.json'))
+        requirements_cache = RequirementsCache(get_cache_file(options, 'requirements.json'))
+        h = compute_reqs_hash(read_requirements(options, cache=requirements_cache), fingerprints)
+        save_caches(options, fingerprints, requirements_cache)
+        return h
+
+    # A builder for every requested session and every combination of their
+    # matrix, each with its own build directory and a dependency directory
+    # shared by variants that need the same dependencies
+    def variants(self, session=None):
+        variants = []
+        for s in self.sessions or [session or 'try:main']:
+            b = self.make(s)
+            for combination in parse_matrix(b.options.get('matrix', [])) or [[]]:
+                variants.append((s, combination, b))
+        if len(variants) == 1 and not variants[0][1]:
+            return [variants[0][2]]
+        variants = [(s, combination) for s, combination, b in variants]
+        deps_dir = abspath(self.flags.get('deps_dir') or os.path.join(os.getcwd(), 'deps'))
+        build_dir = abspath(self.flags.get('build_dir') or os.path.join(os.getcwd(), 'build'))
+        groups = {}
+        for s, combination in variants:
+            groups.setdefault(self.make(s, combination).get_deps_hash(), []).append(get_variant_name(s, combination))
+        group_dirs = {}
+        for names in groups.values():
+            for name in names:
+                group_dirs[name] = deps_dir if len(groups) == 1 else os.path.join(deps_dir, names[0])
+        result = []
+        for s, combination in variants:
+            name = get_variant_name(s, combination)
+            result.append(self.make(s, combination, deps_dir=group_dirs[name], build_dir=os.path.join(build_dir, name)))
+        return result
+
+def get_variant_label(b):
+    return os.path.basename(b.get_build_dir())
+
+# Share the jobs between builders that run at the same time
+def split_jobs(builders, jobs):
+    for b in builders:
+        b.options['jobs'] = max(1, jobs // len(builders))
+
+# Prepare each set of dependencies once, concurrently
+def prepare_variants(builders, **kwargs):
+    prefixes = collections.OrderedDict()
+    for b in builders:
+        prefixes.setdefault(b.get_prefix(), b)
+    bs = list(prefixes.values())
+    split_jobs(bs, bs[0].get_jobs())
+    run_graph({i: [] for i in range(len(bs))}, lambda i: bs[i].prepare(**kwargs), jobs=len(bs), labels=[get_variant_label(b) for b in bs])
+
+# Prepare the dependencies and then run f on every builder concurrently,
+# splitting the jobs between them. When one of them fails the commands of the
+# others are stopped.
+def run_variants(builders, f):
+    jobs = builders[0].get_jobs()
+    prepare_variants(builders)
+    split_jobs(builders, jobs)
+    run_graph({i: [] for i in range(len(builders))}, lambda i: f(builders[i]), jobs=len(builders), labels=[get_variant_label(b) for b in builders])
+
+# Download the sources of the requirements of every builder into the mirror
+def fetch_variants(builders):
+    mirror = builders[0].get_mirror()
+    if mirror is None:
+        raise click.UsageError('No mirror to download to, set with --mirror')
+    reqs = collections.OrderedDict()
+    for b in builders:
+        for req in b.get_requirements():
+            reqs.setdefault(req.line(), (req, b.get_ignore()))
+    items = list(reqs.values())
+    run_graph({i: [] for i in range(len(items))}, lambda i: mirror.fetch(*items[i]), jobs=8)
+
+# Pin the requirements of every builder and write them to rbuild.lock, keeping
+# the entries of lines that are only used by other sessions
+def lock_variants(builders):
+    reqs = collections.OrderedDict()
+    for b in builders:
+        for req in b.get_requirements(locked=False):
+            reqs.setdefault(req.line(), req)
+    lines = list(reqs)
+    entries = {}
+    def f(i):
+        entry = lock_requirement(reqs[lines[i]])
+        if entry:
+            click.echo('Locked {}'.format(' '.join(entry['tokens'])))
+            entries[lines[i]] = entry
+    run_graph({i: [] for i in range(len(lines))}, f, jobs=8)
+    b = builders[0]
+    lock = b.read_lock()
+    lock['version'] = 1
+    lock['requirements'] = merge(lock.get('requirements', {}), entries)
+    tmp = '{}.{}'.format(b.get_lock_file(), os.getpid())
+    with open(tmp, 'w') as out:
+        json.dump(lock, out, indent=2, sort_keys=True)
+        out.write('\n')
+    os.replace(tmp, b.get_lock_file())
+    return lock
+
+# Runs in a worker process to install one shard of the dependencies into its
+# own directory, from which they are added to the cache
+def prepare_shard(sessions, flags, index, deps_dir, shard, jobs, kwargs):
+    import signal
+    # Stop the commands of the shard when the worker is terminated
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(1))
+    task_context.group = ProcessGroup()
+    task_context.label = 'shard {}/{}'.format(*shard)
+    b = BuilderFactory(sessions, **flags).variants()[index]
+    b.options['deps_dir'] = deps_dir
+    b.options['jobs'] = jobs
+    b.prepare(shard=shard, **kwargs)
+
+# Install the dependencies of a builder in count worker processes that share
+# their results through the cache, so the builder then restores them from it
+def run_shards(make_builder, index, count, **kwargs):
+    import multiprocessing
+    import multiprocessing.connection
+    b = make_builder.variants()[index]
+    if b.get_cache() is None:
+        raise click.UsageError('Installing the dependencies in shards needs the cache to be enabled')
+    dirs = [b.get_rbuild_path('shards', str(i)) for i in range(1, count + 1)]
+    jobs = max(1, b.get_jobs() // count)
+    processes = [multiprocessing.Process(target=prepare_shard, args=(make_builder.sessions, make_builder.flags, index, dirs[i - 1], (i, count), jobs, kwargs)) for i in range(1, count + 1)]
+    for p in processes:
+        p.start()
+    pending = list(processes)
+    try:
+        while pending:
+            ready = multiprocessing.connection.wait([p.sentinel for p in pending])
+            for p in [p for p in pending if p.sentinel in ready]:
+                p.join()
+                pending.remove(p)
+                if p.exitcode != 0:
+                    raise RuntimeError('Shard {}/{} failed with exit code {}'.format(processes.index(p) + 1, count, p.exitcode))
+    except BaseException:
+        for p in pending:
+            p.terminate()
+        for p in pending:
+            p.join()
+        raise
+    for d in dirs:
+        delete_dir(d)
+
+def get_watch_paths(b):
+    paths = [b.get_source_dir()]
+    for req in b.get_requirements():
+        if req.local_path():
+            paths.append(req.local_path())
+    return paths
+
+# Build after every change, only installing the dependencies when they
+# changed and only configuring when cmake files changed
+def watch_develop(make_builder, targets, poll=False, interval=1.0):
+    b = make_builder(session='try:develop')
+    h = b.compute_hash()
+    ignore = [b.get_build_dir(), b.get_prefix(), b.get_log_dir()]
+    watcher = Watcher(get_watch_paths(b), ignore=[x for x in ignore if x], interval=interval, poll=poll)
+    def build(b):
+        b.build_targets(list(targets or ['all']))
+    try:
+        try:
+            build(b)
+        except subprocess.CalledProcessError:
+            click.echo('Build failed')
+        while True:
+            click.echo('Watching for changes in ' + ', '.join(watcher.paths))
+            changed = watcher.wait()
+            click.echo('Changed: ' + ', '.join(os.path.relpath(f, b.get_source_dir()) for f in changed[:10]))
+            try:
+                # Settings in rbuild.ini can change as well
+                b = make_builder(session='try:develop')
+                if b.compute_hash() != h:
+                    b.prepare()
+                    h = b.compute_hash()
+                    watcher.paths = [abspath(p) for p in get_watch_paths(b)]
+                b.configure(clean=False, incremental=not any(is_cmake_input(f) for f in changed))
+                build(b)
+            except (subprocess.CalledProcessError, RuntimeError, configparser.Error) as e:
+                click.echo('Build failed: {}'.format(e))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+def build_command(require_deps=True, no_build_dir=False, compiles=True):
     def wrap(f):
         @click.option('-d', '--deps-dir', required=require_deps, help="Directory for the third-party dependencies")
         @click.option('-S', '--source-dir', required=False, help="Directory of the source code", default=os.getcwd())
@@ -296,17 +2574,31 @@ def build_command(require_deps=True, no_build_dir=False):
         @click.option('-t', '--toolchain', required=False, help="Set cmake toolchain file to use")
         @click.option('--cxx', required=False, help="Set c++ compiler")
         @click.option('--cc', required=False, help="Set c compiler")
-        @click.option('-s', '--session', required=False, help="Pick the session to use")
+        @click.option('-s', '--session', multiple=True, help="Pick the session to use")
         @click.option('-D', '--define', multiple=True, help="Extra cmake variables")
         @click.option('-G', '--generator', required=False, help="Set the generator for CMake to use")
         @click.option('--std', required=False, help="Set C++ standard if available")
+        @click.option('--build-type', required=False, help="Set the cmake build type")
+        @click.option('--compiler-launcher', required=False, help="Compiler cache to build with such as ccache or sccache, or 'auto' to use one that is installed")
+        @click.option('-j', '--jobs', required=False, help="Number of compile jobs to run in parallel, or 'auto' to pick from the available cpus and memory")
+        @click.option('--install-jobs', required=False, type=int, help="Number of dependencies to install in parallel")
+        @click.option('--retries', required=False, type=int, help="Number of times to retry installing a dependency that failed")
+        @click.option('--remote-cache', required=False, help="Directory or http url of a cache to share built dependencies between machines")
+        @click.option('--mirror', required=False, help="Directory of the dependency sources downloaded by rbuild fetch")
+        @click.option('--offline', is_flag=True, help="Install the dependencies from the mirror without using the network")
+        @click.option('--trace', required=False, help="Write the commands run and their timings to a file")
+        @click.option('--log-dir', required=False, help="Write the output of each command to a compressed log file in this directory")
         @functools.wraps(f)
-        def w(deps_dir, source_dir, build_dir, toolchain, cxx, cc, define, generator, std, session, *args, **kwargs):
-            arg_session = session
-            def make_builder(session=None):
-                s = arg_session or session or 'try:main'
-                return Builder(session=s, deps_dir=deps_dir, source_dir=source_dir, build_dir=build_dir, toolchain=toolchain, cxx=cxx, cc=cc, define=define, generator=generator, std=std)
-            f(make_builder, *args, **kwargs)
+        def w(deps_dir, source_dir, build_dir, toolchain, cxx, cc, define, generator, std, build_type, compiler_launcher, jobs, install_jobs, retries, remote_cache, mirror, offline, trace, log_dir, session, *args, **kwargs):
+            tracer = Tracer(trace, runs_dir=get_runs_dir(deps_dir) if deps_dir else None)
+            make_builder = BuilderFactory(session, tracer=tracer, launcher_stats=compiles, deps_dir=deps_dir, source_dir=source_dir, build_dir=build_dir, toolchain=toolchain, cxx=cxx, cc=cc, define=define, generator=generator, std=std, build_type=build_type, compiler_launcher=compiler_launcher, jobs=jobs, install_jobs=install_jobs, retries=retries, remote_cache=remote_cache, mirror=mirror, offline='on' if offline else None, log_dir=log_dir)
+            ok = False
+            try:
+                f(make_builder, *args, **kwargs)
+                make_builder.report()
+                ok = True
+            finally:
+                tracer.close(ok)
         return w
     return wrap
 
@@ -317,38 +2609,122 @@ def cli():
 
 @cli.command()
 @build_command(no_build_dir=False)
-def prepare(builder):
-    b = builder()
-    b.prepare(init_with_define_flag=True)
+@click.option('--shard', help="Only install the dependencies in shard i of n, such as 2/4, to share the work between machines through the cache")
+@click.option('--shards', type=int, help="Install the dependencies in this many worker processes")
+def prepare(builder, shard, shards):
+    variants = builder.variants()
+    if shard:
+        prepare_variants(variants, init_with_define_flag=True, shard=parse_shard(shard))
+        return
+    if shards and shards > 1:
+        prefixes = collections.OrderedDict()
+        for i, b in enumerate(variants):
+            prefixes.setdefault(b.get_prefix(), i)
+        for i in prefixes.values():
+            run_shards(builder, i, shards, init_with_define_flag=True)
+    prepare_variants(variants, init_with_define_flag=True)
 
 @cli.command()
-@build_command(no_build_dir=False, require_deps=False)
+@build_command(no_build_dir=False, require_deps=False, compiles=False)
 def hash(builder):
-    b = builder()
-    click.echo(b.compute_hash())
+    click.echo(builder.compute_hash())
+
+@cli.command()
+@build_command(no_build_dir=True, require_deps=False, compiles=False)
+def fetch(builder):
+    fetch_variants(builder.variants())
+
+@cli.command()
+@build_command(no_build_dir=True, require_deps=False, compiles=False)
+def lock(builder):
+    lock_variants(builder.variants())
+
+@cli.command()
+@build_command(no_build_dir=True, require_deps=False, compiles=False)
+@click.option('--dump', is_flag=True, help="Print all the resolved settings as json")
+@click.argument('names', nargs=-1)
+def config(builder, dump, names):
+    variants = builder.variants()
+    if names:
+        for name in names:
+            for b in variants:
+                value = b.options.get(name)
+                lines = value if isinstance(value, list) else [] if value is None else [value]
+                for line in lines:
+                    click.echo('{}{}'.format('[{}] '.format(get_variant_label(b)) if len(variants) > 1 else '', line))
+    if dump or not names:
+        result = variants[0].options if len(variants) == 1 else {get_variant_label(b): b.options for b in variants}
+        click.echo(json.dumps(result, indent=2, sort_keys=True, default=str))
+    if variants[0].get_cache_file('config.json'):
+        get_config_cache().save()
+
+@cli.command()
+@build_command(no_build_dir=True, compiles=False)
+@click.option('--json', 'as_json', is_flag=True, help="Print the summary as json")
+@click.option('--threshold', type=float, default=0.25, help="Slowdown compared to previous runs to report")
+def report(builder, as_json, threshold):
+    runs = read_runs(get_runs_dir(builder.flags['deps_dir']))
+    if not runs:
+        raise click.UsageError('No runs recorded in ' + builder.flags['deps_dir'])
+    summaries = [summarize_run(records) for records in runs]
+    summary = summaries[-1]
+    regressions = get_regressions(summary, [s for s in summaries[:-1] if s['ok']], threshold)
+    if as_json:
+        click.echo(json.dumps(merge(summary, {'regressions': regressions}), indent=2))
+    else:
+        echo_report(summary, regressions)
+
+@cli.command()
+@build_command(no_build_dir=True, require_deps=False, compiles=False)
+def gc(builder):
+    cache = builder().get_cache()
+    if cache is None:
+        click.echo('The cache is disabled')
+        return
+    freed = cache.evict()
+    click.echo('Removed {:.1f}M from {}'.format(freed / (1 << 20), cache.path))
 
 @cli.command()
 @build_command()
-def package(builder):
-    b = builder()
-    b.prepare()
-    b.configure(clean=True)
-    b.build('package')
+@click.option('--clean', is_flag=True, help="Always configure a clean build directory")
+@click.option('--package-generator', multiple=True, help="CPack generator to create packages with, such as DEB, RPM or TGZ")
+def package(builder, clean, package_generator):
+    def f(b):
+        b.configure(clean=True, incremental=not clean)
+        generators = list(package_generator) or b.get_package_generators()
+        if not generators:
+            b.build('package')
+            return
+        # Build once so each cpack only has to install and package
+        b.build('all')
+        run_graph({g: [] for g in generators}, b.cpack, jobs=len(generators), labels={g: g for g in generators})
+    run_variants(builder.variants(), f)
 
 @cli.command()
 @build_command()
 @click.option('-T', '--target', multiple=True, help="Target to build")
-def build(builder, target):
-    b = builder()
-    b.prepare()
-    b.configure(clean=True)
-    for t in target or ['all']:
-        b.build(t)
+@click.option('--clean', is_flag=True, help="Always configure a clean build directory")
+@click.option('--shard', help="Only build the targets in shard i of n, such as 2/4, to share the targets between machines")
+def build(builder, target, clean, shard):
+    if shard:
+        i, n = parse_shard(shard)
+        target = list(target or ['all'])[i - 1::n]
+        if not target:
+            return
+    def f(b):
+        b.configure(clean=True, incremental=not clean)
+        b.build_targets(list(target or ['all']))
+    run_variants(builder.variants(), f)
 
 @cli.command()
 @build_command(require_deps=False)
-def develop(builder):
+@click.option('--watch', is_flag=True, help="Rebuild when the sources, requirements or rbuild.ini change")
+@click.option('-T', '--target', multiple=True, help="Target to build when watching")
+@click.option('--poll', is_flag=True, help="Watch for changes by polling instead of using inotify")
+@click.option('--interval', type=float, default=1.0, help="Seconds between polls when watching")
+def develop(builder, watch, target, poll, interval):
     b = builder(session='try:develop')
     b.prepare()
     b.configure(clean=False)
-
+    if watch:
+        watch_develop(builder, target, poll=poll, interval=interval)
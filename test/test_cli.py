@@ -1,5 +1,12 @@
+import click, gzip, hashlib, http.server, io, itertools, json, os, pytest, shutil, subprocess, sys, tarfile, threading, time
 from unittest import mock
-from rbuild.cli import get_rocm_path
+from rbuild.cli import get_rocm_path, read_reqs, RequirementsCache, find_compiler_launcher, get_launcher_stats, parse_matrix, BuilderFactory, get_auto_jobs, get_cgroup_cpus, get_req_graph, run_graph, get_cget_fname, parse_size, run_command, Builder, DepCache, Fingerprints, Requirement, RemoteCache, DirectoryBackend, Tracer, Watcher, ConfigCache, get_session_options, get_remote_backend, get_shards, parse_shard, get_github_commit, get_url_digest, lock_variants, Mirror, get_source_url, lock_requirement, summarize_run, get_regressions, read_runs
+
+# Keep the caches of the tests out of the user's cache directory
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+    monkeypatch.setenv('RBUILD_CACHE_DIR', tmpdir.join('rbuild-cache').strpath)
+    monkeypatch.setattr('rbuild.cli.config_cache', None)
 
 def test_get_rocm_path_from_env(monkeypatch):
     monkeypatch.setenv('ROCM_PATH', '/custom/rocm')
@@ -24,3 +31,859 @@ def test_get_rocm_path_no_glob(monkeypatch):
     monkeypatch.delenv('ROCM_PATH', raising=False)
     with mock.patch('glob.glob', return_value=[]):
         assert get_rocm_path() == '/opt/rocm'
+
+def test_requirement_name():
+    assert Requirement(['pfultz2/half@1.12.0', '-X', 'header']).name() == 'pfultz2/half'
+    assert Requirement(['rocm-cmake,https://github.com/x/archive/master.tar.gz']).name() == 'rocm-cmake'
+    assert Requirement(['-DFOO=1', '-H', 'sha256:abc', 'boost']).name() == 'boost'
+
+def test_req_graph_local_requires(tmpdir):
+    tmpdir.mkdir('a')
+    tmpdir.mkdir('c')
+    tmpdir.mkdir('b').join('requirements.txt').write('a\n')
+    reqs = [Requirement(['a'], tmpdir.strpath), Requirement(['c'], tmpdir.strpath), Requirement(['b'], tmpdir.strpath)]
+    assert get_req_graph(reqs) == {0: [], 1: [], 2: [0]}
+
+def test_req_graph_unknown_requires(tmpdir):
+    tmpdir.mkdir('a').join('requirements.txt').write('')
+    tmpdir.mkdir('c').join('requirements.txt').write('')
+    reqs = [Requirement(['a'], tmpdir.strpath), Requirement(['x/y@1'], tmpdir.strpath), Requirement(['c'], tmpdir.strpath), Requirement(['z/w@1'], tmpdir.strpath)]
+    assert get_req_graph(reqs) == {0: [], 1: [0], 2: [1], 3: [0, 1, 2]}
+    assert get_req_graph(reqs, unknown=False) == {0: [], 1: [], 2: [], 3: []}
+
+def test_req_graph_requires_not_listed(tmpdir):
+    # Both would install x/y into the prefix at the same time
+    tmpdir.mkdir('b').join('requirements.txt').write('x/y@1\n')
+    tmpdir.mkdir('c').join('requirements.txt').write('x/y@1\nignored/dep\n')
+    reqs = [Requirement(['b,./b'], tmpdir.strpath), Requirement(['c,./c'], tmpdir.strpath)]
+    assert get_req_graph(reqs, ignore=['ignored']) == {0: [], 1: [0]}
+    # b would install its own a while a is installed
+    tmpdir.mkdir('a').join('requirements.txt').write('')
+    tmpdir.join('b', 'requirements.txt').write('a\n')
+    reqs = [Requirement(['b,./b'], tmpdir.strpath), Requirement(['a,./a'], tmpdir.strpath)]
+    assert get_req_graph(reqs) == {0: [], 1: [0]}
+
+def test_req_graph_mirror(tmpdir):
+    b_url = make_source_archive(tmpdir, 'b')
+    a_url = make_source_archive(tmpdir, 'a', 'b,{}\n'.format(b_url))
+    c_url = make_source_archive(tmpdir, 'c')
+    mirror = Mirror(tmpdir.join('mirror').strpath)
+    reqs = [Requirement(['b,' + b_url]), Requirement(['c,' + c_url]), Requirement(['a,' + a_url])]
+    for req in reqs:
+        mirror.fetch(req)
+    assert get_req_graph(reqs, mirror=mirror) == {0: [], 1: [], 2: [0]}
+    assert get_req_graph(reqs) == {0: [], 1: [0], 2: [0, 1]}
+
+def test_run_graph_order():
+    order = []
+    run_graph({0: [], 1: [0], 2: [], 3: [1, 2]}, order.append, jobs=3)
+    assert order.index(0) < order.index(1) < order.index(3)
+    assert order.index(2) < order.index(3)
+
+def test_run_graph_failure():
+    def f(key):
+        if key == 1: raise ValueError(key)
+    with pytest.raises(ValueError):
+        run_graph({0: [], 1: [], 2: [1]}, f, jobs=2)
+
+def test_run_graph_cancels_siblings(tmpdir):
+    b = Builder('try:main', source_dir=tmpdir.strpath, cache_dir='none')
+    def f(key):
+        if key == 0:
+            b.cmd([sys.executable, '-c', 'import time; time.sleep(60)'])
+        else:
+            time.sleep(0.5)
+            raise ValueError(key)
+    start = time.time()
+    with pytest.raises(ValueError):
+        run_graph({0: [], 1: []}, f, jobs=2)
+    assert time.time() - start < 30
+
+@pytest.mark.skipif(os.name != 'posix', reason='process groups are posix only')
+def test_run_graph_sessions(tmpdir):
+    def pgids(jobs):
+        out = tmpdir.join('pgid{}'.format(jobs))
+        run_graph({0: [], 1: []}, lambda key: run_command([sys.executable, '-c', 'import os; print(os.getpgid(0))'], stdout=out.open('a')), jobs=jobs)
+        return [int(x) for x in out.read().split()]
+    assert pgids(1) == [os.getpgid(0)] * 2
+    assert os.getpgid(0) not in pgids(2)
+
+forward_signals_script = '''
+import sys
+from rbuild.cli import run_graph, run_command
+run_graph({0: [], 1: []}, lambda key: run_command([sys.executable, '-c', 'import os, time; print(os.getpid(), flush=True); time.sleep(60)'], stdout=open(sys.argv[1], 'a')), jobs=2)
+'''
+
+@pytest.mark.skipif(os.name != 'posix', reason='process groups are posix only')
+def test_run_graph_forwards_signals(tmpdir):
+    pids = tmpdir.join('pids')
+    p = subprocess.Popen([sys.executable, '-c', forward_signals_script, pids.strpath])
+    start = time.time()
+    while len(pids.read().split() if pids.exists() else []) < 2 and time.time() - start < 30:
+        time.sleep(0.1)
+    p.terminate()
+    assert p.wait(30) != 0
+    time.sleep(0.5)
+    for pid in pids.read().split():
+        with pytest.raises(OSError):
+            os.kill(int(pid), 0)
+
+def test_run_graph_prefixes_output(tmpdir, capsys):
+    b = Builder('try:main', source_dir=tmpdir.strpath, cache_dir='none')
+    run_graph({0: [], 1: []}, lambda key: b.cmd([sys.executable, '-c', 'print("hello")']), jobs=2, labels=['a', 'b'])
+    lines = capsys.readouterr().out.splitlines()
+    assert '[a] hello' in lines
+    assert '[b] hello' in lines
+
+def test_config_cache(tmpdir):
+    ini = tmpdir.join('rbuild.ini')
+    ini.write('[main]\ncxx = g++\n[other]\ncxx = ${deps_dir}/clang++\n')
+    os.utime(ini.strpath, (time.time() - 10, time.time() - 10))
+    cache = ConfigCache(tmpdir.join('config.json').strpath)
+    defaults = {'source_dir': tmpdir.strpath, 'deps_dir': '/deps'}
+    with mock.patch('rbuild.cli.get_session_options', wraps=get_session_options) as f:
+        assert cache.get_session_options('try:main', defaults=defaults)['cxx'] == 'g++'
+        assert cache.get_session_options('try:main', defaults=defaults)['cxx'] == 'g++'
+        assert cache.get_session_options('other', defaults=defaults)['cxx'] == '/deps/clang++'
+        assert f.call_count == 2
+        cache.save()
+        assert ConfigCache(tmpdir.join('config.json').strpath).get_session_options('other', defaults=defaults)['cxx'] == '/deps/clang++'
+        assert f.call_count == 2
+        ini.write('[main]\ncxx = clang++\n')
+        assert cache.get_session_options('try:main', defaults=defaults)['cxx'] == 'clang++'
+        assert f.call_count == 3
+
+def test_config_cache_build_dirs(tmpdir):
+    ini = tmpdir.join('rbuild.ini')
+    ini.write('[main]\ncxx = ${deps_dir}/clang++\ndefine =\n    CMAKE_PREFIX_PATH=${build_dir}/prefix\n')
+    os.utime(ini.strpath, (time.time() - 10, time.time() - 10))
+    cache = ConfigCache(tmpdir.join('config.json').strpath)
+    with mock.patch('rbuild.cli.get_session_options', wraps=get_session_options) as f:
+        for d in ['a', 'b']:
+            options = cache.get_session_options('main', defaults={'source_dir': tmpdir.strpath, 'deps_dir': '/{}/deps'.format(d), 'build_dir': '/{}/build'.format(d)})
+            assert options['cxx'] == '/{}/deps/clang++'.format(d)
+            assert options['define'] == ['CMAKE_PREFIX_PATH=/{}/build/prefix'.format(d)]
+            assert options['deps_dir'] == '/{}/deps'.format(d)
+        assert f.call_count == 1
+    assert len(cache.entries) == 1
+
+def test_cache_prune(tmpdir):
+    files = []
+    for i in range(3):
+        f = tmpdir.join('f{}'.format(i))
+        f.write(str(i))
+        os.utime(f.strpath, (time.time() - 10, time.time() - 10))
+        files.append(f.strpath)
+    cache = Fingerprints(tmpdir.join('fingerprints.json').strpath)
+    cache.max_entries = 2
+    for f in files:
+        cache.hash_file(f)
+    cache.hash_file(files[0])
+    cache.save()
+    assert list(Fingerprints(tmpdir.join('fingerprints.json').strpath).entries) == [files[2], files[0]]
+    os.remove(files[2])
+    cache.changed = True
+    cache.save()
+    assert list(Fingerprints(tmpdir.join('fingerprints.json').strpath).entries) == [files[0]]
+    cache = ConfigCache(tmpdir.join('config.json').strpath)
+    ini = tmpdir.mkdir('src').join('rbuild.ini')
+    ini.write('[main]\ncxx = g++\n')
+    os.utime(ini.strpath, (time.time() - 10, time.time() - 10))
+    cache.get_session_options('main', defaults={'source_dir': ini.dirname})
+    cache.save()
+    assert len(ConfigCache(tmpdir.join('config.json').strpath).entries) == 1
+    ini.remove()
+    cache.changed = True
+    cache.save()
+    assert ConfigCache(tmpdir.join('config.json').strpath).entries == {}
+
+def test_get_shards():
+    graph = {0: [], 1: [0], 2: [], 3: [1], 4: [], 5: [2]}
+    assert get_shards(graph, 2) == [[0, 1, 3], [2, 4, 5]]
+    assert get_shards(graph, 3) == [[0, 1, 3], [2, 5], [4]]
+    assert get_shards({0: []}, 2) == [[0], []]
+
+def test_parse_shard():
+    assert parse_shard('2/4') == (2, 4)
+    for s in ['0/4', '5/4', '2', 'a/b']:
+        with pytest.raises(click.BadParameter):
+            parse_shard(s)
+
+def test_prepare_shard(tmpdir):
+    tmpdir.join('requirements.txt').write('a/b@1\nc/d@1\ne/f@1\n')
+    b = Builder('try:main', source_dir=tmpdir.strpath, deps_dir=tmpdir.join('deps').strpath, cache_dir='none')
+    with mock.patch.object(Builder, 'cget') as cget:
+        b.prepare(shard=(2, 2))
+    calls = [c[0] for c in cget.call_args_list]
+    assert [c for c in calls if c[0] == 'install'] == [('install', '-f', tmpdir.join('deps', 'rbuild', 'requirements', '1.txt').strpath)]
+    assert not tmpdir.join('deps', 'hash').exists()
+
+def prepare_cache_keys(tmpdir, reqs, shard=None):
+    tmpdir.join('requirements.txt').write(reqs)
+    b = Builder('try:main', source_dir=tmpdir.strpath, deps_dir=tmpdir.join('deps', str(shard)).strpath, cache_dir=tmpdir.join('cache').strpath)
+    with mock.patch.object(Builder, 'cget'), mock.patch.object(DepCache, 'restore', return_value=False) as restore:
+        b.prepare(shard=shard)
+    return [c[0][0] for c in restore.call_args_list]
+
+# A dependency with unknown requirements is built without the ones in other
+# shards, so it can't be restored in place of one built with them
+def test_prepare_shard_cache_keys(tmpdir):
+    keys = prepare_cache_keys(tmpdir, 'a/b@1\nc/d@1\n')
+    assert prepare_cache_keys(tmpdir, 'a/b@1\nc/d@1\n', shard=(1, 2)) == keys[:1]
+    assert prepare_cache_keys(tmpdir, 'a/b@1\nc/d@1\n', shard=(2, 2)) != keys[1:]
+    tmpdir.mkdir('a').join('CMakeLists.txt').write('project(a)')
+    tmpdir.mkdir('b').join('requirements.txt').write('a\n')
+    tmpdir.mkdir('c')
+    keys = prepare_cache_keys(tmpdir, 'a,./a\nb,./b\nc,./c\n')
+    assert prepare_cache_keys(tmpdir, 'a,./a\nb,./b\nc,./c\n', shard=(1, 2)) == keys[:2]
+    assert prepare_cache_keys(tmpdir, 'a,./a\nb,./b\nc,./c\n', shard=(2, 2)) == keys[2:]
+
+def prepare_calls(tmpdir, reqs, **kwargs):
+    tmpdir.join('requirements.txt').write(reqs)
+    b = Builder('try:main', source_dir=tmpdir.strpath, deps_dir=tmpdir.join('deps').strpath, **kwargs)
+    with mock.patch.object(Builder, 'cget') as cget:
+        b.prepare()
+    return [c[0] for c in cget.call_args_list]
+
+def test_prepare_incremental(tmpdir):
+    calls = prepare_calls(tmpdir, 'a/b@1\nc/d@1\n')
+    assert calls[0] == ('clean', '-y')
+    assert len([c for c in calls if c[0] == 'install']) == 2
+    assert prepare_calls(tmpdir, 'a/b@1\nc/d@1\n') == []
+    calls = prepare_calls(tmpdir, 'a/b@2\n')
+    assert ('remove', '-y', 'a/b@1') in calls
+    assert ('remove', '-y', 'c/d@1') in calls
+    assert len([c for c in calls if c[0] == 'install']) == 1
+
+def test_prepare_compiler_changed(tmpdir):
+    with mock.patch('rbuild.cli.get_compiler_identity', return_value='/usr/bin/c++ 1'):
+        prepare_calls(tmpdir, 'a/b@1\n', cache_dir='none')
+        assert prepare_calls(tmpdir, 'a/b@1\n', cache_dir='none') == []
+    with mock.patch('rbuild.cli.get_compiler_identity', return_value='/usr/bin/c++ 2'):
+        calls = prepare_calls(tmpdir, 'a/b@1\n', cache_dir='none')
+    assert calls[0] == ('clean', '-y')
+    # The cache keys differ too
+    keys = []
+    for version in ['1', '2']:
+        with mock.patch('rbuild.cli.get_compiler_identity', return_value='/usr/bin/c++ ' + version), mock.patch.object(DepCache, 'restore', return_value=False) as restore:
+            prepare_calls(tmpdir.mkdir('v' + version), 'a/b@1\n', cache_dir=tmpdir.join('cache').strpath)
+        keys.append(restore.call_args[0][0])
+    assert keys[0] != keys[1]
+
+def test_prepare_reinstalls_dependents(tmpdir):
+    tmpdir.mkdir('a').join('CMakeLists.txt').write('project(a)')
+    tmpdir.mkdir('b').join('requirements.txt').write('a\n')
+    tmpdir.mkdir('c')
+    prepare_calls(tmpdir, 'a,./a\nb,./b\nc,./c\n')
+    time.sleep(0.01)
+    tmpdir.join('a', 'CMakeLists.txt').write('project(a2)')
+    calls = prepare_calls(tmpdir, 'a,./a\nb,./b\nc,./c\n')
+    assert sorted(c[2] for c in calls if c[0] == 'remove') == ['a,' + tmpdir.join('a').strpath, 'b,' + tmpdir.join('b').strpath]
+
+# cget that fails to install the requirement files for which fail returns true
+def failing_cget(fail):
+    def f(*args, **kwargs):
+        if args[0] == 'install' and fail(args[-1]):
+            raise subprocess.CalledProcessError(1, ['cget'] + list(args))
+    return f
+
+def test_prepare_resume(tmpdir):
+    tmpdir.join('requirements.txt').write('a/b@1\nc/d@1\ne/f@1\n')
+    b = Builder('try:main', source_dir=tmpdir.strpath, deps_dir=tmpdir.join('deps').strpath, cache_dir='none')
+    with mock.patch.object(Builder, 'cget', side_effect=failing_cget(lambda f: f.endswith('1.txt'))):
+        with pytest.raises(subprocess.CalledProcessError):
+            b.prepare()
+    assert sorted(b.read_manifest()['deps']) == ['a/b']
+    calls = prepare_calls(tmpdir, 'a/b@1\nc/d@1\ne/f@1\n')
+    assert ('clean', '-y') not in calls
+    assert len([c for c in calls if c[0] == 'install']) == 2
+
+def test_prepare_retry(tmpdir):
+    tmpdir.join('requirements.txt').write('a/b@1\n')
+    for retries, succeeds in [('2', True), ('1', False)]:
+        failures = [1, 1]
+        b = Builder('try:main', source_dir=tmpdir.strpath, deps_dir=tmpdir.join('deps' + retries).strpath, cache_dir='none', retries=retries, retry_delay='0')
+        with mock.patch.object(Builder, 'cget', side_effect=failing_cget(lambda f: failures and failures.pop())):
+            if succeeds:
+                b.prepare()
+            else:
+                with pytest.raises(subprocess.CalledProcessError):
+                    b.prepare()
+
+def make_source_archive(tmpdir, name, requirements=None, files=None):
+    src = tmpdir.join('src', name + '-1')
+    src.join('CMakeLists.txt').write('project({})'.format(name), ensure=True)
+    if requirements:
+        src.join('requirements.txt').write(requirements)
+    for f, content in (files or {}).items():
+        src.join(f).write(content, ensure=True)
+    archive = tmpdir.join(name + '.tar.gz')
+    with tarfile.open(archive.strpath, 'w:gz') as t:
+        t.add(src.strpath, arcname=name + '-1')
+    return 'file://' + archive.strpath
+
+def test_mirror_fetch(tmpdir):
+    b_url = make_source_archive(tmpdir, 'b')
+    a_url = make_source_archive(tmpdir, 'a', '-f deps/extra.txt\nignored/dep\n', {'deps/extra.txt': 'b,{}\n'.format(b_url)})
+    mirror = Mirror(tmpdir.join('mirror').strpath)
+    mirror.fetch(Requirement(['a,' + a_url, '-DX=1']), ignore=['ignored'])
+    assert sorted(mirror.index.entries) == [a_url, b_url]
+    # Files included with -f are read from the archive
+    assert mirror.get(a_url)['requires'] == ['b,' + b_url, 'ignored/dep']
+    tokens = mirror.get_install_tokens(Requirement(['a,' + a_url, '-DX=1']), ignore=['ignored'])
+    assert [x[0] for x in tokens] == ['b,' + os.path.join(mirror.path, mirror.get(b_url)['file']), 'a,' + os.path.join(mirror.path, mirror.get(a_url)['file'])]
+    assert tokens[1][1:] == ['-DX=1']
+    with pytest.raises(RuntimeError):
+        Mirror(tmpdir.join('mirror2').strpath).fetch(Requirement([a_url, '-H', 'sha256:0']))
+    # Left to cget to download unless offline
+    assert mirror.get_install_tokens(Requirement(['c/d@1'])) == [['c/d@1']]
+    with pytest.raises(RuntimeError):
+        mirror.get_install_tokens(Requirement(['c/d@1']), offline=True)
+
+def test_mirror_single_name(tmpdir):
+    assert get_source_url(Requirement(['zlib@v1'])) == 'https://github.com/zlib/zlib/archive/v1.tar.gz'
+    assert get_source_url(Requirement(['zlib/zlib'])) == 'https://github.com/zlib/zlib/archive/HEAD.tar.gz'
+    assert lock_requirement(Requirement(['zlib'])) is None
+    recipes = tmpdir.join('recipes')
+    recipes.join('boost', 'package.txt').write('boost', ensure=True)
+    mirror = Mirror(tmpdir.join('mirror').strpath, [recipes.strpath])
+    with mock.patch.object(Mirror, 'download') as download:
+        mirror.fetch(Requirement(['boost']))
+    download.assert_not_called()
+    assert mirror.get_install_tokens(Requirement(['boost'])) == [['boost']]
+    for req in ['boost', 'zlib']:
+        with pytest.raises(RuntimeError):
+            mirror.get_install_tokens(Requirement([req]), offline=True)
+
+def test_prepare_offline(tmpdir):
+    url = make_source_archive(tmpdir, 'a')
+    tmpdir.join('requirements.txt').write('a,{}\n'.format(url))
+    def prepare(**kwargs):
+        b = Builder('try:main', source_dir=tmpdir.strpath, deps_dir=tmpdir.join('deps').strpath, cache_dir='none', mirror=tmpdir.join('mirror').strpath, **kwargs)
+        with mock.patch.object(Builder, 'cget'):
+            b.prepare()
+        return b
+    with pytest.raises(RuntimeError):
+        prepare(offline='on')
+    # Downloaded into the mirror while preparing
+    b = prepare()
+    entry = b.get_mirror().get(url)
+    assert tmpdir.join('deps', 'rbuild', 'requirements', '0.txt').read().startswith('a,' + tmpdir.join('mirror', entry['file']).strpath)
+
+def test_prepare_install_jobs_env(tmpdir, capsys):
+    tmpdir.mkdir('a')
+    tmpdir.mkdir('b')
+    tmpdir.join('requirements.txt').write('a\nb\n')
+    for generator, level in [('Ninja', '2'), (None, '4')]:
+        b = Builder('try:main', source_dir=tmpdir.strpath, deps_dir=tmpdir.join('deps', str(generator)).strpath, cache_dir='none', jobs='4', install_jobs=2, generator=generator)
+        with mock.patch.object(Builder, 'cget') as m:
+            b.prepare()
+        envs = [c[1]['env'] for c in m.call_args_list if c[0][0] == 'install']
+        assert [env['CMAKE_BUILD_PARALLEL_LEVEL'] for env in envs] == [level, level]
+    assert 'Warning' in capsys.readouterr().out
+
+def test_prepare_toolchain_change(tmpdir):
+    prepare_calls(tmpdir, 'a/b@1\n')
+    calls = prepare_calls(tmpdir, 'a/b@1\n', cxx='clang++')
+    assert calls[0] == ('clean', '-y')
+
+def test_cget_fname():
+    assert get_cget_fname(Requirement(['pfultz2/half@1.12.0'])) == 'pfultz2__half'
+    assert get_cget_fname(Requirement(['zlib,https://zlib.net/zlib.tar.gz'])) == 'zlib'
+    assert get_cget_fname(Requirement(['https://a.b/c.tar.gz'])).startswith('_url_')
+
+def make_cget_pkg(prefix, name, parent=None):
+    pkg = prefix.join('cget', 'pkg', name)
+    pkg.join('install', 'include', name + '.h').write('// ' + prefix.strpath, ensure=True)
+    if parent:
+        pkg.join('deps', parent).write(parent, ensure=True)
+
+def test_dep_cache_roundtrip(tmpdir):
+    prefix = tmpdir.join('deps1')
+    make_cget_pkg(prefix, 'a')
+    make_cget_pkg(prefix, 'b', parent='a')
+    make_cget_pkg(prefix, 'c')
+    cache = DepCache(tmpdir.mkdir('cache').strpath, parse_size('1G'))
+    cache.store('key', prefix.strpath, 'a')
+    other = tmpdir.join('deps2')
+    assert cache.restore('key', other.strpath)
+    assert not cache.restore('missing', other.strpath)
+    assert sorted(other.join('cget', 'unlink').listdir()) == [other.join('cget', 'unlink', x) for x in ['a', 'b']]
+    assert other.join('cget', 'unlink', 'b', 'install', 'include', 'b.h').read() == '// ' + other.strpath
+
+def test_dep_cache_evict(tmpdir):
+    prefix = tmpdir.join('deps')
+    make_cget_pkg(prefix, 'a')
+    make_cget_pkg(prefix, 'b')
+    cache = DepCache(tmpdir.mkdir('cache').strpath, 1)
+    cache.store('key1', prefix.strpath, 'a')
+    cache.store('key2', prefix.strpath, 'b')
+    assert os.listdir(cache.path) == ['objects']
+    assert [f for _, _, files in os.walk(cache.get_path('objects')) for f in files] == []
+
+def test_dep_cache_dedup_links(tmpdir):
+    cache = DepCache(tmpdir.mkdir('cache').strpath, parse_size('1G'), link='hardlink')
+    for name in ['deps1', 'deps2']:
+        prefix = tmpdir.join(name)
+        make_cget_pkg(prefix, 'a')
+        prefix.join('cget', 'pkg', 'a', 'install', 'lib', 'liba.a').write_binary(b'\0lib', ensure=True)
+        cache.store(name, prefix.strpath, 'a')
+    assert len([f for _, _, files in os.walk(cache.get_path('objects')) for f in files]) == 2
+    for name in ['deps1', 'deps2']:
+        assert cache.restore(name, tmpdir.join('restored').strpath)
+        tmpdir.join('restored', 'cget', 'unlink').rename(tmpdir.join('restored-' + name))
+    libs = [tmpdir.join('restored-' + name, 'a', 'install', 'lib', 'liba.a') for name in ['deps1', 'deps2']]
+    assert libs[0].read_binary() == b'\0lib'
+    assert os.path.samefile(libs[0].strpath, libs[1].strpath)
+    assert tmpdir.join('restored-deps2', 'a', 'install', 'include', 'a.h').read() == '// ' + tmpdir.join('restored').strpath
+
+def test_dep_cache_gc(tmpdir):
+    prefix = tmpdir.join('deps')
+    make_cget_pkg(prefix, 'a')
+    make_cget_pkg(prefix, 'b')
+    prefix.join('cget', 'pkg', 'a', 'install', 'lib', 'liba.a').write_binary(b'\0lib', ensure=True)
+    cache = DepCache(tmpdir.mkdir('cache').strpath, parse_size('1G'))
+    cache.store('key1', prefix.strpath, 'a')
+    cache.store('key2', prefix.strpath, 'b')
+    assert cache.gc() == 0
+    shutil.rmtree(cache.get_path('key1'))
+    assert cache.gc() == 4
+    assert cache.restore('key2', tmpdir.join('other').strpath)
+
+def check_remote_roundtrip(tmpdir, backend):
+    prefix = tmpdir.join('deps1')
+    make_cget_pkg(prefix, 'a')
+    cache1 = DepCache(tmpdir.mkdir('cache1').strpath, parse_size('1G'))
+    cache1.store('key', prefix.strpath, 'a')
+    RemoteCache(backend, cache1).store('key', 'remote')
+    cache2 = DepCache(tmpdir.mkdir('cache2').strpath, parse_size('1G'))
+    remote = RemoteCache(backend, cache2)
+    assert not remote.fetch('other', 'missing')
+    assert remote.fetch('key', 'remote')
+    other = tmpdir.join('deps2')
+    assert cache2.restore('key', other.strpath)
+    assert other.join('cget', 'unlink', 'a', 'install', 'include', 'a.h').read() == '// ' + other.strpath
+
+def test_remote_cache_directory(tmpdir):
+    check_remote_roundtrip(tmpdir, get_remote_backend(tmpdir.join('remote').strpath))
+
+class FileHandler(http.server.SimpleHTTPRequestHandler):
+    def do_PUT(self):
+        with open(self.translate_path(self.path), 'wb') as f:
+            f.write(self.rfile.read(int(self.headers['Content-Length'])))
+        self.send_response(201)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def test_remote_cache_http(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir.mkdir('remote'))
+    server = http.server.HTTPServer(('127.0.0.1', 0), FileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        check_remote_roundtrip(tmpdir, get_remote_backend('http://127.0.0.1:{}/'.format(server.server_port)))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_remote_cache_unsafe_archive(tmpdir):
+    archive = tmpdir.join('bad.tar.gz')
+    with tarfile.open(archive.strpath, 'w:gz') as tar:
+        tar.add(__file__, arcname='../escape.py')
+    cache = DepCache(tmpdir.mkdir('cache').strpath, parse_size('1G'))
+    with open(archive.strpath, 'rb') as f:
+        with pytest.raises(RuntimeError):
+            cache.unpack('key', f)
+    assert os.listdir(cache.path) == []
+    assert not tmpdir.join('escape.py').exists()
+
+def test_remote_cache_symlink_archive(tmpdir):
+    outside = tmpdir.mkdir('outside')
+    archive = tmpdir.join('bad.tar.gz')
+    with tarfile.open(archive.strpath, 'w:gz') as tar:
+        link = tarfile.TarInfo('objects')
+        link.type = tarfile.SYMTYPE
+        link.linkname = outside.strpath
+        tar.addfile(link)
+        tar.add(__file__, arcname='objects/' + 'a' * 64)
+    cache = DepCache(tmpdir.mkdir('cache').strpath, parse_size('1G'))
+    with open(archive.strpath, 'rb') as f:
+        with pytest.raises(RuntimeError):
+            cache.unpack('key', f)
+    assert outside.listdir() == []
+    assert os.listdir(cache.path) == []
+
+def write_cache_archive(path, info, objects):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, content in [('info.json', json.dumps(info).encode('utf-8'))] + [('objects/' + name, content) for name, content in objects.items()]:
+            member = tarfile.TarInfo(name)
+            member.size = len(content)
+            tar.addfile(member, io.BytesIO(content))
+
+def test_remote_cache_link_outside(tmpdir):
+    outside = tmpdir.mkdir('outside')
+    remote = tmpdir.mkdir('remote')
+    obj = hashlib.sha256(b'evil').hexdigest()
+    files = [{'path': 'p/evil', 'link': outside.strpath}, {'path': 'p/evil/file', 'object': obj, 'size': 4, 'relocate': False}]
+    write_cache_archive(remote.join('remote.tar.gz').strpath, {'packages': ['p'], 'files': files}, {obj: b'evil'})
+    cache = DepCache(tmpdir.mkdir('cache').strpath, parse_size('1G'))
+    assert not RemoteCache(DirectoryBackend(remote.strpath), cache).fetch('key', 'remote')
+    assert not cache.has_entry('key')
+    # Links that only get out through other links are refused when restoring
+    files = [{'path': 'p/q', 'dir': True}, {'path': 'p/q/r', 'dir': True}, {'path': 'p/q/r/a', 'link': '../..'}, {'path': 'p/b', 'link': 'q/r/a/../..'},
+             {'path': 'p/b/file', 'object': obj, 'size': 4, 'relocate': False}]
+    write_cache_archive(remote.join('chained.tar.gz').strpath, {'packages': ['p'], 'files': files}, {obj: b'evil'})
+    assert RemoteCache(DirectoryBackend(remote.strpath), cache).fetch('key', 'chained')
+    prefix = tmpdir.join('deps')
+    with pytest.raises(RuntimeError):
+        cache.restore('key', prefix.strpath)
+    assert not prefix.join('cget', 'file').exists()
+    assert outside.listdir() == []
+
+def test_hash_local_dep_contents(tmpdir):
+    tmpdir.join('dep', 'CMakeLists.txt').write('project(dep)', ensure=True)
+    b = Builder('try:main', source_dir=tmpdir.strpath, deps=[tmpdir.join('dep').strpath], cache_dir='none')
+    h1 = b.compute_hash()
+    assert b.compute_hash() == h1
+    tmpdir.join('dep', 'CMakeLists.txt').write('project(dep2)')
+    assert b.compute_hash() != h1
+
+def test_hash_source_dir(tmpdir, monkeypatch):
+    src = tmpdir.mkdir('src')
+    src.join('rbuild.ini').write('[main]\ndeps = -f requirements.txt\n')
+    src.join('requirements.txt').write('a/b@1\n')
+    tmpdir.mkdir('other').join('requirements.txt').write('c/d@1\n')
+    monkeypatch.chdir(tmpdir.join('other'))
+    b = Builder('main', source_dir=src.strpath, cache_dir='none')
+    h = b.compute_hash()
+    src.join('requirements.txt').write('a/b@2\n')
+    assert b.compute_hash() != h
+    assert [req.line() for req in b.get_requirements()] == ['a/b@2']
+
+def test_github_commit():
+    out = b'1111111111111111111111111111111111111111\trefs/tags/v1\n2222222222222222222222222222222222222222\trefs/tags/v1^{}\n'
+    with mock.patch('subprocess.check_output', return_value=out) as m:
+        assert get_github_commit('owner/repo', 'v1') == '2' * 40
+    assert m.call_args[0][0] == ['git', 'ls-remote', 'https://github.com/owner/repo', 'v1']
+    assert get_github_commit('owner/repo', 'a' * 40) == 'a' * 40
+    with mock.patch('subprocess.check_output', return_value=b''):
+        with pytest.raises(RuntimeError):
+            get_github_commit('owner/repo', 'missing')
+
+def test_url_digest(tmpdir):
+    f = tmpdir.join('pkg.tar.gz')
+    f.write('content')
+    import urllib.request
+    assert get_url_digest('file:' + urllib.request.pathname2url(f.strpath)) == 'sha256:ed7002b439e9ac845f22357d822bac1444730fbdb6016d3ec9432297b9ec9f73'
+
+def test_lock(tmpdir):
+    tmpdir.join('dep', 'CMakeLists.txt').write('project(dep)', ensure=True)
+    deps = ['owner/repo@v1 -DX=1', 'pkg,https://example.com/pkg.tar.gz -H sha256:abc', 'recipe', tmpdir.join('dep').strpath]
+    def builder():
+        return Builder('try:main', source_dir=tmpdir.strpath, deps=deps, cache_dir='none')
+    h = builder().compute_hash()
+    with mock.patch('rbuild.cli.get_github_commit', return_value='c' * 40), mock.patch('rbuild.cli.get_url_digest', return_value='sha256:def') as m:
+        lock_variants([builder()])
+    m.assert_called_once_with('https://github.com/owner/repo/archive/{}.tar.gz'.format('c' * 40))
+    lock = json.loads(tmpdir.join('rbuild.lock').read())
+    assert sorted(lock['requirements']) == sorted(deps[:2])
+    b = builder()
+    assert [req.line() for req in b.get_requirements()] == ['owner/repo@{} -DX=1 -H sha256:def'.format('c' * 40)] + deps[1:]
+    assert b.get_requirements()[0].name() == 'owner/repo'
+    assert b.compute_hash() != h
+
+def test_fingerprints_reuse(tmpdir):
+    f = tmpdir.join('file.txt')
+    f.write('a')
+    os.utime(f.strpath, (0, 0))
+    fp = Fingerprints(tmpdir.join('fingerprints.json').strpath)
+    digest = fp.hash_path(f.strpath)
+    fp.save()
+    fp = Fingerprints(tmpdir.join('fingerprints.json').strpath)
+    with mock.patch('builtins.open', side_effect=AssertionError):
+        assert fp.hash_path(f.strpath) == digest
+
+def test_configure_incremental(tmpdir):
+    build_dir = tmpdir.join('build')
+    def cmake(*args, **kwargs):
+        build_dir.join('CMakeCache.txt').write('')
+    def configure(**kwargs):
+        b = Builder('try:main', source_dir=tmpdir.strpath, deps_dir=tmpdir.join('deps').strpath, build_dir=build_dir.strpath, cache_dir='none', **kwargs)
+        with mock.patch.object(Builder, 'cmake', side_effect=cmake) as m:
+            b.configure(clean=True, incremental=True)
+        return m.call_count
+    assert configure() == 1
+    assert configure() == 0
+    assert configure(define=['FOO=1']) == 1
+    assert configure(define=['FOO=1']) == 0
+
+def test_build_targets(tmpdir):
+    build_dir = tmpdir.join('build')
+    b = Builder('try:main', source_dir=tmpdir.strpath, build_dir=build_dir.strpath, cache_dir='none')
+    def build(version):
+        build_dir.join('CMakeCache.txt').write('CMAKE_CACHE_MAJOR_VERSION:INTERNAL=3\nCMAKE_CACHE_MINOR_VERSION:INTERNAL={}\n'.format(version), ensure=True)
+        with mock.patch.object(Builder, 'cmake') as m:
+            b.build_targets(['a', 'b'])
+        return [list(c[0]) for c in m.call_args_list]
+    assert build(25) == [['--build', build_dir.strpath, '--config', 'Release', '--target', 'a', 'b']]
+    assert [c[-1] for c in build(10)] == ['a', 'b']
+
+@pytest.mark.skipif(shutil.which('cmake') is None or shutil.which('make') is None, reason='needs cmake and make')
+def test_build_make_targets(tmpdir):
+    src = tmpdir.join('src')
+    src.join('CMakeLists.txt').write("""
+cmake_minimum_required(VERSION 3.5)
+project(targets NONE)
+add_custom_target(a COMMAND ${CMAKE_COMMAND} -E touch a.txt)
+add_custom_target(b COMMAND ${CMAKE_COMMAND} -E touch b.txt)
+install(FILES CMakeLists.txt DESTINATION share)
+""", ensure=True)
+    build_dir = tmpdir.join('build')
+    subprocess.check_call(['cmake', '-G', 'Unix Makefiles', '-DCMAKE_INSTALL_PREFIX=' + tmpdir.join('install').strpath, src.strpath], cwd=build_dir.ensure(dir=True).strpath, stdout=subprocess.DEVNULL)
+    b = Builder('try:main', source_dir=src.strpath, build_dir=build_dir.strpath, cache_dir='none')
+    with mock.patch.object(Builder, 'build', side_effect=Builder.build, autospec=True) as build:
+        b.build_targets(['a', 'install', 'b'])
+    # Only install isn't in Makefile2
+    assert [c[0][1] for c in build.call_args_list] == ['install']
+    assert build_dir.join('a.txt').exists() and build_dir.join('b.txt').exists()
+    assert tmpdir.join('install', 'share', 'CMakeLists.txt').exists()
+
+def test_package_generators(tmpdir, monkeypatch):
+    from rbuild.cli import cli
+    monkeypatch.setenv('RBUILD_CACHE_DIR', tmpdir.join('cache', 'rbuild').strpath)
+    tmpdir.join('rbuild.ini').write('[main]\npackage_generator =\n    DEB\n    RPM\n')
+    def package(*args):
+        with mock.patch.object(Builder, 'prepare'), mock.patch.object(Builder, 'configure'), mock.patch.object(Builder, 'cmd') as m:
+            cli(['package', '-S', tmpdir.strpath, '-d', tmpdir.join('deps').strpath, '-B', tmpdir.join('build').strpath] + list(args), standalone_mode=False)
+        return [c[0][0] for c in m.call_args_list]
+    calls = package()
+    assert calls[0][:2] == ['cmake', '--build'] and '--target' not in calls[0]
+    assert sorted(calls[1:]) == [['cpack', '-G', 'DEB', '-C', 'Release'], ['cpack', '-G', 'RPM', '-C', 'Release']]
+    assert package('--package-generator', 'TGZ')[1:] == [['cpack', '-G', 'TGZ', '-C', 'Release']]
+
+def test_trace_jsonl(tmpdir):
+    # The records of the run before are dropped
+    tmpdir.join('trace.jsonl').write('{"phase": "old"}\n')
+    tracer = Tracer(tmpdir.join('trace.jsonl').strpath)
+    b = Builder('try:main', source_dir=tmpdir.strpath, cache_dir='none', tracer=tracer)
+    with b.phase('build'):
+        b.cmd([sys.executable, '-c', 'pass'])
+        with pytest.raises(subprocess.CalledProcessError):
+            b.cmd([sys.executable, '-c', 'raise SystemExit(3)'])
+    tracer.close()
+    records = [json.loads(line) for line in tmpdir.join('trace.jsonl').readlines()]
+    assert [r.get('exit_code') for r in records] == [0, 3, None]
+    assert [r['phase'] for r in records] == ['build'] * 3
+    assert all(r['wall'] >= 0 for r in records)
+
+def test_trace_chrome(tmpdir):
+    tracer = Tracer(tmpdir.join('trace.json').strpath)
+    with tracer.phase('prepare'):
+        tracer.add(run_command([sys.executable, '-c', 'pass']))
+    tracer.close()
+    events = json.loads(tmpdir.join('trace.json').read())['traceEvents']
+    assert [e['ph'] for e in events] == ['X', 'X']
+    assert events[1]['name'] == 'prepare'
+
+def make_run(a_wall, cached=False):
+    return [
+        {'run': 'prepare -d deps', 'start': 0, 'wall': 20, 'cpus': 4, 'ok': True, 'launchers': {'ccache': [3, 1]}},
+        {'phase': 'prepare', 'dep': 'a', 'start': 0, 'wall': a_wall, 'cached': cached, 'requires': []},
+        {'phase': 'prepare', 'dep': 'b', 'start': 0, 'wall': 1, 'cached': False, 'requires': []},
+        {'phase': 'prepare', 'dep': 'c', 'start': a_wall, 'wall': 2, 'cached': False, 'requires': ['a', 'b']},
+        {'phase': 'prepare', 'command': ['cget', 'install'], 'start': 0, 'wall': a_wall, 'user': a_wall * 2, 'sys': 0, 'maxrss_kb': 2048},
+        {'phase': 'prepare', 'start': 0, 'wall': a_wall + 2}
+    ]
+
+def test_summarize_run():
+    summary = summarize_run(make_run(10))
+    assert summary['critical_path'] == ['a', 'c']
+    assert summary['critical_path_wall'] == 12
+    assert summary['phases']['prepare']['utilization'] == 20.0 / (12 * 4)
+    assert summary['peak_memory_kb'] == 2048
+    assert list(summary['deps']) == ['a', 'c', 'b']
+    assert summary['slowest'][0]['command'] == 'cget install'
+    previous = [summarize_run(make_run(4)), summarize_run(make_run(5)), summarize_run(make_run(1, cached=True))]
+    assert [r['name'] for r in get_regressions(summary, previous)] == ['phase prepare', 'a']
+    assert get_regressions(summarize_run(make_run(10, cached=True)), previous) == [{'name': 'phase prepare', 'wall': 12, 'baseline': 6}]
+    # Only compared with runs of the same command
+    other = summarize_run(make_run(10))
+    other['run'] = 'build -d deps'
+    assert get_regressions(other, previous) == []
+
+def test_save_runs(tmpdir):
+    for i in range(3):
+        tracer = Tracer(runs_dir=tmpdir.join('runs').strpath)
+        with tracer.phase('prepare'):
+            pass
+        tracer.close(ok=i != 1)
+    with mock.patch('rbuild.cli.max_runs', 2):
+        tracer.close()
+    runs = read_runs(tmpdir.join('runs').strpath)
+    assert len(runs) == 2
+    assert [run[0]['ok'] for run in runs] == [False, True]
+    assert runs[-1][0]['ok'] and runs[-1][1]['phase'] == 'prepare'
+
+def fake_files(files):
+    return lambda f: files.get(f, '')
+
+def test_cgroup_cpus_v2():
+    with mock.patch('rbuild.cli.read_first_line', fake_files({'/sys/fs/cgroup/cpu.max': '250000 100000'})):
+        assert get_cgroup_cpus() == 3
+
+def test_cgroup_cpus_v1():
+    files = {'/sys/fs/cgroup/cpu.max': '', '/sys/fs/cgroup/cpu/cpu.cfs_quota_us': '200000', '/sys/fs/cgroup/cpu/cpu.cfs_period_us': '100000'}
+    with mock.patch('rbuild.cli.read_first_line', fake_files(files)):
+        assert get_cgroup_cpus() == 2
+
+def test_cgroup_cpus_unlimited():
+    with mock.patch('rbuild.cli.read_first_line', fake_files({'/sys/fs/cgroup/cpu.max': 'max 100000'})):
+        assert get_cgroup_cpus() is None
+
+def test_auto_jobs_memory():
+    with mock.patch('rbuild.cli.get_cpu_count', return_value=64), mock.patch('rbuild.cli.get_available_memory', return_value=parse_size('10G')):
+        assert get_auto_jobs(parse_size('2G')) == 5
+        assert get_auto_jobs(parse_size('32G')) == 1
+    with mock.patch('rbuild.cli.get_cpu_count', return_value=8), mock.patch('rbuild.cli.get_available_memory', return_value=None):
+        assert get_auto_jobs(parse_size('2G')) == 8
+
+def test_parse_matrix():
+    assert parse_matrix([]) == []
+    assert parse_matrix(['cxx = g++ clang++', 'define = A=1']) == [[('cxx', 'g++'), ('define', 'A=1')], [('cxx', 'clang++'), ('define', 'A=1')]]
+
+matrix_ini = '''
+[ci]
+matrix =
+    cxx = g++ clang++
+    build_type = Release Debug
+'''
+
+def test_builder_variants(tmpdir):
+    tmpdir.join('rbuild.ini').write(matrix_ini)
+    factory = BuilderFactory(['ci'], source_dir=tmpdir.strpath, deps_dir=tmpdir.join('deps').strpath, build_dir=tmpdir.join('build').strpath, cache_dir='none')
+    variants = factory.variants()
+    assert [os.path.basename(b.get_build_dir()) for b in variants] == ['ci-g++-Release', 'ci-g++-Debug', 'ci-clang++-Release', 'ci-clang++-Debug']
+    assert [os.path.basename(b.get_prefix()) for b in variants] == ['ci-g++-Release', 'ci-g++-Release', 'ci-clang++-Release', 'ci-clang++-Release']
+    assert variants[1].get_configure_defines() == ['CMAKE_BUILD_TYPE=Debug']
+
+def test_builder_single_variant(tmpdir):
+    factory = BuilderFactory([], source_dir=tmpdir.strpath, deps_dir=tmpdir.join('deps').strpath, build_dir=tmpdir.join('build').strpath, cache_dir='none')
+    b = factory()
+    assert b.get_prefix() == tmpdir.join('deps').strpath
+    assert b.get_build_dir() == tmpdir.join('build').strpath
+
+def test_find_compiler_launcher():
+    assert find_compiler_launcher(None) is None
+    assert find_compiler_launcher('none') is None
+    with mock.patch('shutil.which', side_effect=lambda x: '/usr/bin/sccache' if x == 'sccache' else None):
+        assert find_compiler_launcher('auto') == '/usr/bin/sccache'
+    with mock.patch('shutil.which', return_value=None):
+        assert find_compiler_launcher('auto') is None
+
+def test_launcher_stats_ccache():
+    out = b'direct_cache_hit\t3\npreprocessed_cache_hit\t2\ncache_miss\t4\n'
+    with mock.patch('subprocess.check_output', return_value=out):
+        assert get_launcher_stats('/usr/bin/ccache') == (5, 4)
+
+def test_launcher_stats_sccache():
+    out = json.dumps({'stats': {'cache_hits': {'counts': {'C/C++': 7}}, 'cache_misses': {'counts': {'C/C++': 1, 'HIP': 2}}}}).encode('utf-8')
+    with mock.patch('subprocess.check_output', return_value=out):
+        assert get_launcher_stats('sccache') == (7, 3)
+
+def test_launcher_defines(tmpdir):
+    b = Builder('try:main', source_dir=tmpdir.strpath, cache_dir='none', compiler_launcher='/usr/bin/ccache', build_type='Debug')
+    assert b.get_configure_defines()[:4] == ['CMAKE_C_COMPILER_LAUNCHER=/usr/bin/ccache', 'CMAKE_CXX_COMPILER_LAUNCHER=/usr/bin/ccache', 'CMAKE_HIP_COMPILER_LAUNCHER=/usr/bin/ccache', 'CMAKE_BUILD_TYPE=Debug']
+
+def test_read_reqs_cycle(tmpdir):
+    tmpdir.join('a.txt').write('x/y\n-f b.txt\n')
+    tmpdir.join('b.txt').write('-f a.txt\n')
+    with pytest.raises(RuntimeError, match='Recursive'):
+        list(read_reqs(['-f a.txt'], path=tmpdir.join('rbuild.ini').strpath))
+
+def test_read_reqs_cache(tmpdir):
+    tmpdir.join('a.txt').write('x/y -DFOO="a b"\n-f b.txt\n')
+    tmpdir.join('b.txt').write('z/w # comment\n')
+    for f in ['a.txt', 'b.txt']:
+        os.utime(tmpdir.join(f).strpath, (0, 0))
+    cache_file = tmpdir.join('requirements.json').strpath
+    cache = RequirementsCache(cache_file)
+    reqs = list(read_reqs(['-f a.txt'], path=tmpdir.join('rbuild.ini').strpath, cache=cache))
+    assert reqs == ['x/y -DFOO=a b', 'z/w']
+    cache.save()
+    cache = RequirementsCache(cache_file)
+    with mock.patch('rbuild.cli.read_from', side_effect=AssertionError):
+        assert list(read_reqs(['-f a.txt'], path=tmpdir.join('rbuild.ini').strpath, cache=cache)) == reqs
+    tmpdir.join('b.txt').write('z/w@1\n')
+    assert list(read_reqs(['-f a.txt'], path=tmpdir.join('rbuild.ini').strpath, cache=cache)) == ['x/y -DFOO=a b', 'z/w@1']
+
+def test_cache_dir_not_writable(tmpdir, monkeypatch):
+    # A file where the cache directory should be
+    tmpdir.join('cache').write('')
+    monkeypatch.setenv('RBUILD_CACHE_DIR', tmpdir.join('cache', 'rbuild').strpath)
+    tmpdir.join('requirements.txt').write('a/b@1\n')
+    b = Builder('try:main', source_dir=tmpdir.strpath, deps_dir=tmpdir.join('deps').strpath)
+    assert len(b.compute_hash()) == 32
+    assert b.get_cache() is None
+
+# The hash command is run often in ci to compute cache keys, so it doesn't
+# set up a builder or run the compiler launcher for its stats
+def test_hash_fast_path(tmpdir, monkeypatch, capsys):
+    from rbuild.cli import cli
+    tmpdir.mkdir('dep').join('CMakeLists.txt').write('project(dep)')
+    tmpdir.join('requirements.txt').write('a/b@1\n./dep\n')
+    expected = Builder('try:main', source_dir=tmpdir.strpath).compute_hash()
+    with mock.patch('rbuild.cli.get_launcher_stats') as stats, mock.patch.object(Builder, '__init__', side_effect=AssertionError):
+        cli(['hash', '-S', tmpdir.strpath, '--compiler-launcher', 'auto'], standalone_mode=False)
+    stats.assert_not_called()
+    assert capsys.readouterr().out.strip() == expected
+
+def test_cmd_log_capture(tmpdir, capsys):
+    b = Builder('try:main', source_dir=tmpdir.strpath, cache_dir='none', log_dir=tmpdir.join('logs').strpath, log_tail='3')
+    b.cmd([sys.executable, '-c', 'for i in range(100): print("line", i)'])
+    out = capsys.readouterr().out
+    assert 'line 99' in out
+    assert 'line 96' not in out
+    log = tmpdir.join('logs').listdir()[0]
+    assert log.basename.endswith('.log.gz')
+    with gzip.open(log.strpath, 'rb') as f:
+        assert len(f.read().splitlines()) == 100
+
+# Each run names its logs after itself, so runs sharing the directory don't
+# overwrite each other's logs
+def test_cmd_log_runs(tmpdir):
+    for i in range(2):
+        b = Builder('try:main', source_dir=tmpdir.strpath, cache_dir='none', log_dir=tmpdir.join('logs').strpath)
+        # Each run is a new process, counting its commands from the start
+        with mock.patch('rbuild.cli.log_counter', itertools.count(1)):
+            b.cmd([sys.executable, '-c', 'print("run {}")'.format(i)])
+    logs = sorted(tmpdir.join('logs').listdir())
+    assert len(logs) == 2
+    for i, log in enumerate(logs):
+        with gzip.open(log.strpath, 'rb') as f:
+            assert f.read().strip() == 'run {}'.format(i).encode()
+
+def test_cmd_log_capture_failure(tmpdir, capsys):
+    b = Builder('try:main', source_dir=tmpdir.strpath, cache_dir='none', log_dir=tmpdir.join('logs').strpath, log_tail='3')
+    with pytest.raises(subprocess.CalledProcessError):
+        b.cmd([sys.executable, '-c', 'import sys\nfor i in range(100): print("line", i)\nsys.exit(1)'])
+    out = capsys.readouterr().out
+    assert 'line 0\n' in out
+    assert 'line 99' in out
+
+@pytest.mark.parametrize('poll', [True, False])
+def test_watcher(tmpdir, poll):
+    tmpdir.join('src', 'a.cpp').write('a', ensure=True)
+    tmpdir.join('build', 'b.o').write('b', ensure=True)
+    watcher = Watcher([tmpdir.strpath], ignore=[tmpdir.join('build').strpath], interval=0.05, poll=poll)
+    def change():
+        time.sleep(0.2)
+        tmpdir.join('build', 'b.o').write('bb')
+        tmpdir.join('src', 'a.cpp').write('aa')
+        tmpdir.join('src', 'new', 'c.cpp').write('c', ensure=True)
+    threading.Thread(target=change).start()
+    try:
+        assert watcher.wait(debounce=0.2) == [tmpdir.join('src', 'a.cpp').strpath, tmpdir.join('src', 'new', 'c.cpp').strpath]
+    finally:
+        watcher.close()
+
@@ -60,6 +60,11 @@ def run_rb(d, src='simple', ini='', args=[], requirements=None):
 def d(tmpdir):
     return DirForTests(tmpdir.strpath)
 
+# Keep the caches of the tests out of the user's cache directory
+@pytest.fixture(autouse=True)
+def cache_dir(tmpdir, monkeypatch):
+    monkeypatch.setenv('RBUILD_CACHE_DIR', tmpdir.join('rbuild-cache').strpath)
+
 def test_hash(d):
     src = get_path('simple')
     rb('hash', cwd=src)
@@ -113,6 +118,28 @@ def test_package_flag(d):
     rb('package', '-B', build, '-d', deps, '-DCMAKE_BUILD_TYPE=Debug', cwd=src)
 
 
+def test_prepare_shared_cache_gc(d):
+    env = dict(os.environ, RBUILD_CACHE_DIR=d.get_path('cache'))
+    src = get_path('simple')
+    rb('prepare', '-d', d.get_path('deps1'), cwd=src, env=env)
+    rb('prepare', '-d', d.get_path('deps2'), cwd=src, env=env)
+    rb('gc', cwd=src, env=env)
+
+def test_prepare_shards(d):
+    env = dict(os.environ, RBUILD_CACHE_DIR=d.get_path('cache'))
+    deps = d.get_path('deps')
+    build = d.get_path('build')
+    src = get_path('simple')
+    rb('prepare', '-d', deps, '--shards', '2', cwd=src, env=env)
+    rb('package', '-B', build, '-d', deps, cwd=src, env=env)
+
+def test_prepare_shard(d):
+    env = dict(os.environ, RBUILD_CACHE_DIR=d.get_path('cache'))
+    src = get_path('simple')
+    rb('prepare', '-d', d.get_path('shard1'), '--shard', '1/2', cwd=src, env=env)
+    rb('prepare', '-d', d.get_path('shard2'), '--shard', '2/2', cwd=src, env=env)
+    rb('package', '-B', d.get_path('build'), '-d', d.get_path('deps'), cwd=src, env=env)
+
 def test_optional_build(d):
     deps = d.get_path('deps')
     src = d.get_path('src')
@@ -248,6 +275,28 @@ def test_custom_session_ini2(d):
 def test_custom_session_ini3(d):
     run_rb(d, ini=custom_session_ini, args=['build', '-s', 'bar'])
 
+multiple_session_ini = '''
+[foo]
+deps = -f requirements.txt
+[bar]
+deps = -f requirements.txt
+define = CMAKE_BUILD_TYPE=Debug
+'''
+def test_multiple_session_ini(d):
+    run_rb(d, ini=multiple_session_ini, args=['build', '-s', 'foo', '-s', 'bar'])
+
+matrix_ini = '''
+[main]
+deps = -f requirements.txt
+matrix =
+    build_type = Release Debug
+'''
+def test_matrix_ini(d):
+    run_rb(d, ini=matrix_ini, args=['build'])
+
+def test_matrix_ini_package(d):
+    run_rb(d, ini=matrix_ini, args=['package'])
+
 multiple_deps_ini = '''
 [main]
 deps = 
@@ -257,6 +306,12 @@ deps =
 def test_multiple_deps_ini(d):
     run_rb(d, ini=multiple_deps_ini, args=['build'])
 
+def test_multiple_deps_ini_jobs(d):
+    run_rb(d, ini=multiple_deps_ini, args=['build', '-j', '2'])
+
+def test_multiple_deps_ini_install_jobs(d):
+    run_rb(d, ini=multiple_deps_ini, args=['build', '--install-jobs', '2'])
+
 rocm_path_ini = '''
 [main]
 cxx = ${rocm_path}/llvm/bin/clang++
@@ -289,6 +344,12 @@ def test_simple_build_ini_ninja(d):
 def test_simple_develop_ini_ninja(d):
     run_rb(d, ini=simple_build_ini, args=['develop', '-G', 'Ninja'])
 
+def test_build_compiler_launcher_auto(d):
+    deps = d.get_path('deps')
+    build = d.get_path('build')
+    src = get_path('simple')
+    rb('build', '-B', build, '-d', deps, '--compiler-launcher', 'auto', cwd=src)
+
 def test_build_std(d):
     deps = d.get_path('deps')
     build = d.get_path('build')